@@ -0,0 +1,158 @@
+""" End-to-end deploy benchmark for every backend, fed by a local stub of the DNS API.
+
+Run from the repository root: python -m bench.backends [--zones 200] [--records 50] [--backends powerdns,tinydns]
+
+PowerDNS runs against a fresh SQLite database unless --database-url is given. Only point that at a scratch database,
+the benchmark creates, fills and rewrites its tables. TinyDNS and hellomouse write to a temporary directory, and the
+pm2 restarts of hellomouse are stubbed out.
+
+The bot logs through its usual queue, to /dev/null unless --verbose is given. Compare runs with different --log-level
+values to see what logging costs, DEBUG logs every zone and rejected record.
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from aiohttp import web
+
+from zonebot.logs import setup_logging
+
+from .payload import DEFAULT_MIX, generate_payload, parse_mix
+
+BACKENDS = ('powerdns', 'tinydns', 'hellomouse')
+
+
+async def start_stub_api(raw: bytes, port: int):
+    """ Serves the payload like the real API does, including ETag based conditional requests """
+    etag = f'"{hash(raw):x}"'
+
+    async def handler(request):
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304)
+        return web.Response(body=raw, content_type='application/json', headers={'ETag': etag})
+
+    app = web.Application()
+    app.router.add_get('/dns', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    await site.start()
+    return runner
+
+
+def make_config(workdir: str, api_url: str, args) -> SimpleNamespace:
+    os.makedirs(f"{workdir}/zones")
+    os.makedirs(f"{workdir}/coredns")
+    return SimpleNamespace(
+        API_URL=api_url,
+        DATABASE_URL=args.database_url or f"sqlite:///{workdir}/powerdns.db",
+        POWERDNS_SYNC_MODE=args.sync_mode,
+        DEPLOY_CONCURRENCY=args.concurrency,
+        ZONEFILE_LOCATION=f"{workdir}/zones",
+        COREDNS_LOCATION=f"{workdir}/coredns",
+        TINYDNS_CDB_LOCATION=f"{workdir}/data.cdb" if args.cdb else None,
+        IPV4_ADDR="127.0.0.1",
+        IPV6_ADDR="::1",
+        DO_NOT_DELETE_DOMAINS=[],
+        SOA_NS="ns1.pissnet.cc.",
+        SOA_EMAIL="hostmaster.piss.domains.",
+        NAMESERVERS=['a.piss.domains', 'b.piss.domains', 'c.piss.domains'],
+    )
+
+
+def make_backend(backend: str, config):
+    if backend == 'powerdns':
+        from zonebot.powerdns import PowerDNSZoneBot, metadata
+        server = PowerDNSZoneBot(None, 'bench', config, headless=True)
+        metadata.create_all(server.engine)
+    elif backend == 'tinydns':
+        from zonebot.tinydns import TinyDNSZoneBot
+        server = TinyDNSZoneBot(None, 'bench', config, headless=True)
+    else:
+        from zonebot.hellomouse import HellomouseZoneBot
+        server = HellomouseZoneBot(None, 'bench', config, headless=True)
+        server._restart = lambda service: None  # Don't restart anything
+    return server
+
+
+async def run_backend(backend: str, args, api_url: str, trace_memory: bool) -> dict:
+    """ One cold deploy followed by a no-op deploy, in a fresh working directory """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix=f"bench-{backend}-") as workdir:
+        os.chdir(workdir)  # last_data_ts and the digests live in the working directory
+        try:
+            server = make_backend(backend, make_config(workdir, api_url, args))
+            if trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            await server.update_dns(force=True)
+            cold = time.perf_counter() - start
+            start = time.perf_counter()
+            await server.update_dns(force=True)
+            warm = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+            await server.session.close()
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+            os.chdir(cwd)
+    return {'cold': cold, 'warm': warm, 'peak': peak}
+
+
+async def main_async(args):
+    mix = parse_mix(args.mix) if args.mix else DEFAULT_MIX
+    payload = generate_payload(args.zones, args.records, mix)
+    raw = json.dumps(payload).encode()
+    runner = await start_stub_api(raw, args.port)
+    api_url = f"http://127.0.0.1:{args.port}/dns"
+    total_records = args.zones * args.records
+    print(f"{args.zones} zones x {args.records} records ({len(raw) / 1024 / 1024:.1f} MiB payload), "
+          f"concurrency {args.concurrency}, log level {args.log_level}")
+    log_output = None if args.verbose else open(os.devnull, 'w')
+    listener = setup_logging(SimpleNamespace(LOG_LEVEL_IRC=args.log_level, LOG_LEVEL_DEPLOY=args.log_level),
+                             stream=log_output)
+    print(f"{'backend':<12}{'cold deploy':>14}{'records/s':>14}{'no-op deploy':>15}{'peak memory':>14}")
+    try:
+        for backend in args.backends.split(','):
+            timings = [await run_backend(backend, args, api_url, False) for _ in range(args.rounds)]
+            cold = min(t['cold'] for t in timings)
+            warm = min(t['warm'] for t in timings)
+            peak = ''
+            if not args.no_memory:
+                peak = f"{(await run_backend(backend, args, api_url, True))['peak'] / 1024 / 1024:.1f} MiB"
+            print(f"{backend:<12}{cold:>13.3f}s{total_records / cold:>14,.0f}{warm:>14.3f}s{peak:>14}")
+    finally:
+        await runner.cleanup()
+        listener.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--zones', type=int, default=200)
+    parser.add_argument('--records', type=int, default=50, help="Records per zone")
+    parser.add_argument('--mix', help=f"Record type weights, default {','.join(f'{k}={v}' for k, v in DEFAULT_MIX.items())}")
+    parser.add_argument('--backends', default=','.join(BACKENDS))
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--database-url', help="PowerDNS database, a fresh SQLite database by default")
+    parser.add_argument('--sync-mode', default='replace', choices=('replace', 'diff'))
+    parser.add_argument('--cdb', action='store_true', help="Also compile TinyDNS data.cdb")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the (slow) peak memory measurement")
+    parser.add_argument('--port', type=int, default=8053)
+    parser.add_argument('--log-level', default='INFO', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+                        help="Level of the IRC and deploy logs of the bot")
+    parser.add_argument('--verbose', action='store_true', help="Show the logs of the bot while deploying")
+    args = parser.parse_args()
+    for backend in args.backends.split(','):
+        if backend not in BACKENDS:
+            parser.error(f"Unknown backend {backend}")
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
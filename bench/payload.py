@@ -0,0 +1,52 @@
+""" Synthetic DNS API payloads, in the shape BaseZoneBot.update_dns expects """
+import random
+
+# Relative weight of every record type in a zone
+DEFAULT_MIX = {'A': 40, 'AAAA': 15, 'CNAME': 15, 'TXT': 15, 'MX': 8, 'CAA': 4, 'NS': 3}
+
+VALUES = {
+    'A': lambda i: f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}",
+    'AAAA': lambda i: f"2001:db8::{i:x}",
+    'CNAME': lambda i: f"target{i}.example.",
+    'TXT': lambda i: f"v=spf1 include:_spf{i}.example ~all",
+    'MX': lambda i: f"{i % 50} mx{i}.example.",
+    'CAA': lambda i: '0 issue "letsencrypt.org"',
+    'NS': lambda i: f"ns{i}.example.",
+}
+
+
+def parse_mix(text: str) -> dict[str, int]:
+    """ Parses a record type mix like "A=5,TXT=2" """
+    mix = {}
+    for item in text.split(','):
+        record_type, weight = item.split('=')
+        if record_type not in VALUES:
+            raise ValueError(f"Unknown record type {record_type}")
+        mix[record_type] = int(weight)
+    return mix
+
+
+def generate_zone(name: str, records: int, mix: dict = None, invalid_ratio=0.01, last_modified="1",
+                  rnd: random.Random = None) -> dict:
+    rnd = rnd or random.Random(0)
+    mix = mix or DEFAULT_MIX
+    types = rnd.choices(list(mix), weights=list(mix.values()), k=records)
+    recs = []
+    for i, record_type in enumerate(types):
+        value = VALUES[record_type](i)
+        if rnd.random() < invalid_ratio:
+            value = "not valid at all"
+        recs.append({'name': f"host{i}", 'type': record_type, 'value': value})
+    return {'name': name, 'owner': "bench", 'last_modified': last_modified, 'records': recs}
+
+
+def generate_payload(zones: int, records_per_zone: int, mix: dict = None, invalid_ratio=0.01, last_modified="1",
+                     seed=0) -> dict:
+    rnd = random.Random(seed)
+    return {
+        'last_modified': last_modified,
+        'domains': [
+            generate_zone(f"zone{i}.piss", records_per_zone, mix, invalid_ratio, last_modified, rnd)
+            for i in range(zones)
+        ],
+    }
@@ -0,0 +1,39 @@
+""" Microbenchmark for the record validation stage.
+
+Run from the repository root: python -m bench.validation [--records 100000]
+"""
+import argparse
+import time
+from types import SimpleNamespace
+
+from zonebot.validation import validate_zone
+
+from .payload import generate_zone
+
+CONFIG = SimpleNamespace(
+    SOA_NS="ns1.pissnet.cc.",
+    SOA_EMAIL="hostmaster.piss.domains.",
+    NAMESERVERS=['a.piss.domains', 'b.piss.domains', 'c.piss.domains'],
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    zone = generate_zone("bench.piss", args.records)
+    timings = []
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        records, rejected = validate_zone(zone, CONFIG)
+        timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+    print(f"{args.records} records: {len(records)} accepted, {len(rejected)} rejected")
+    print(f"best of {args.rounds}: {best * 1000:.1f} ms ({args.records / best:,.0f} records/s)")
+
+
+if __name__ == '__main__':
+    main()
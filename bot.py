@@ -5,19 +5,16 @@ from ircrobots import Bot as BaseBot
 from ircrobots import ConnectionParams
 from ircrobots.security import TLS_NOVERIFY
 
+from zonebot import create_server
+from zonebot.logs import setup_logging
+from zonebot.metrics import metrics
+
 try:
     import config
 except ImportError:
     print("You forgot to move the config.py file")
     sys.exit()
 
-if config.DNS_SERVER == 'powerdns':
-    from zonebot.powerdns import PowerDNSZoneBot as Server
-elif config.DNS_SERVER == 'tinydns':
-    from zonebot.tinydns import TinyDNSZoneBot as Server
-elif config.DNS_SERVER == 'hellomouse':
-    from zonebot.hellomouse import HellomouseZoneBot as Server
-
 
 SERVERS = [
     ("piss", config.SERVER),
@@ -26,10 +23,14 @@ SERVERS = [
 
 class Bot(BaseBot):
     def create_server(self, name: str):
-        return Server(self, name, config=config)
+        return create_server(self, name, config)
 
 
 async def main():
+    setup_logging(config)
+    if getattr(config, 'METRICS_PORT', None):
+        await metrics.serve(getattr(config, 'METRICS_HOST', "127.0.0.1"), config.METRICS_PORT)
+
     bot = Bot()
     for name, host in SERVERS:
         params = ConnectionParams(config.NICK, host, 6697, tls=TLS_NOVERIFY)
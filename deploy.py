@@ -0,0 +1,139 @@
+""" Runs a single deploy to the configured DNS_SERVER without connecting to IRC, e.g. from cron.
+
+    python deploy.py                          # from the API_URL in config.py
+    python deploy.py --source zones.json      # from a local copy of the payload
+    python deploy.py --dry-run                # only report what would change
+    python deploy.py --snapshot               # from the last payload we deployed
+    python deploy.py --profile cpu            # write cProfile stats to deploy.prof
+"""
+import argparse
+import asyncio
+import cProfile
+import json
+import pstats
+import sys
+import tracemalloc
+from concurrent.futures import Executor
+from contextlib import contextmanager
+
+from zonebot import create_server
+from zonebot.logs import setup_logging
+
+try:
+    import config
+except ImportError:
+    print("You forgot to move the config.py file")
+    sys.exit()
+
+
+class ProfiledExecutor(Executor):
+    """ Profiles every job of an executor in its own thread, before 3.12 cProfile only sees the thread it runs in """
+
+    def __init__(self, executor: Executor):
+        self.executor = executor
+        self.profilers: list[cProfile.Profile] = []
+
+    def submit(self, fn, /, *args, **kwargs):
+        return self.executor.submit(self._run, fn, args, kwargs)
+
+    def _run(self, fn, args, kwargs):
+        profiler = cProfile.Profile()
+        self.profilers.append(profiler)
+        profiler.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.disable()
+
+
+@contextmanager
+def profiled(profile: str, output: str, executors: list[ProfiledExecutor] = ()):
+    """ Profiles the block with cProfile or tracemalloc, dumps the results to output and prints a summary """
+    if profile == 'cpu':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        yield
+        profiler.disable()
+        stats = pstats.Stats(profiler)
+        for executor in executors:
+            for thread_profiler in executor.profilers:
+                stats.add(thread_profiler)
+        stats.dump_stats(output or "deploy.prof")
+        stats.sort_stats('cumulative').print_stats(25)
+    elif profile == 'memory':
+        tracemalloc.start(25)
+        yield
+        snapshot = tracemalloc.take_snapshot()
+        print(f"Peak traced memory: {tracemalloc.get_traced_memory()[1] / 1024 / 1024:.1f} MiB")
+        tracemalloc.stop()
+        snapshot.dump(output or "deploy.tracemalloc")
+        for stat in snapshot.statistics('lineno')[:10]:
+            print(stat)
+    else:
+        yield
+
+
+async def deploy(server, args):
+    is_url = args.source is None or args.source.startswith(('http://', 'https://'))
+    if is_url:
+        server.api_url = args.source or server.api_url
+
+    if args.dry_run:
+        if is_url:
+            raw_data, _ = await server.fetch_dns_data(force=True)
+        else:
+            with open(args.source, 'rb') as f:
+                raw_data = f.read()
+        domains = json.loads(raw_data)['domains']
+        for backend in [server, *server.mirrors]:
+            if server.mirrors:
+                print(f"{backend.dns_server}:")
+            for line in backend.dry_run(domains):
+                print(line)
+    elif args.snapshot:
+        await server.deploy_snapshot()
+    elif is_url:
+        await server.update_dns(force=args.force)
+    else:
+        with open(args.source, 'rb') as f:
+            await server.deploy_payload(f.read(), {}, force=args.force)
+
+
+async def run(args):
+    listener = setup_logging(config, fmt="%(message)s")
+    server = create_server(None, "deploy", config, headless=True)
+    executors = []
+    if args.profile == 'cpu':
+        for backend in [server, *server.mirrors]:
+            # Keep every zone in the profiled deploy thread
+            backend.deploy_concurrency = 1
+            if sys.version_info < (3, 12):
+                backend.parse_executor = ProfiledExecutor(backend.parse_executor)
+                backend.deploy_executor = ProfiledExecutor(backend.deploy_executor)
+                executors += [backend.parse_executor, backend.deploy_executor]
+
+    try:
+        with profiled(args.profile, args.profile_output, executors):
+            await deploy(server, args)
+    finally:
+        if server.session is not None:
+            await server.session.close()
+        listener.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--source', help="URL or JSON file to deploy, API_URL by default")
+    parser.add_argument('--snapshot', action='store_true', help="Deploy the latest snapshot, e.g. when the API is down")
+    parser.add_argument('--force', action='store_true', help="Deploy even if the payload didn't change")
+    parser.add_argument('--dry-run', action='store_true', help="Validate and compare, without touching the DNS server")
+    parser.add_argument('--profile', choices=('cpu', 'memory'),
+                        help="Profile with cProfile or tracemalloc")
+    parser.add_argument('--profile-output', help="Where to dump the profile, deploy.prof or deploy.tracemalloc by default")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import os
+import shutil
+import struct
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from zonebot.cdb import TinyDNSData, cdb_hash
+
+# data is an output-zones with every line type TinyDNSData compiles, and data.cdb what tinydns-data builds from it
+# with the mtime of data (the default SOA serial) set to DATA_MTIME:
+#   touch -d @1700000000 data && tinydns-data
+# test_fixture_is_current rebuilds it wherever tinydns-data is installed.
+FIXTURES = Path(__file__).parent / 'fixtures' / 'tinydns'
+DATA_MTIME = 1700000000
+
+
+def read_cdb(path) -> dict[bytes, list[bytes]]:
+    """ Every key of a cdb with its values in order, looked up through the hash tables like cdb_find does """
+    with open(path, 'rb') as f:
+        db = f.read()
+    tables = [struct.unpack_from('<LL', db, 8 * i) for i in range(256)]
+
+    keys = []
+    pos = 2048
+    end = min(table_pos for table_pos, _ in tables)
+    while pos < end:
+        key_len, data_len = struct.unpack_from('<LL', db, pos)
+        keys.append(db[pos + 8:pos + 8 + key_len])
+        pos += 8 + key_len + data_len
+    assert pos == end
+
+    entries = {}
+    for key in dict.fromkeys(keys):
+        h = cdb_hash(key)
+        table_pos, slots = tables[h & 255]
+        values = []
+        for i in range(slots):
+            slot_hash, record_pos = struct.unpack_from('<LL', db, table_pos + 8 * (((h >> 8) + i) % slots))
+            if not record_pos:
+                break
+            key_len, data_len = struct.unpack_from('<LL', db, record_pos)
+            if slot_hash == h and db[record_pos + 8:record_pos + 8 + key_len] == key:
+                values.append(db[record_pos + 8 + key_len:record_pos + 8 + key_len + data_len])
+        entries[key] = values
+    return entries
+
+
+def compile_fixture(path):
+    data = TinyDNSData(DATA_MTIME)
+    with open(FIXTURES / 'data', 'rb') as f:
+        for line in f:
+            data.add_line(line)
+    with open(path, 'wb') as f:
+        data.write(f)
+
+
+def compare_cdb(path, expected_path):
+    expected = read_cdb(expected_path)
+    compiled = read_cdb(path)
+
+    assert compiled.keys() == expected.keys()
+    for key, values in expected.items():
+        assert compiled[key] == values, key
+
+
+def test_matches_tinydns_data(tmp_path):
+    compile_fixture(tmp_path / 'compiled.cdb')
+    compare_cdb(tmp_path / 'compiled.cdb', FIXTURES / 'data.cdb')
+
+
+@pytest.mark.skipif(not shutil.which('tinydns-data'), reason="needs tinydns-data")
+def test_fixture_is_current(tmp_path):
+    shutil.copy(FIXTURES / 'data', tmp_path / 'data')
+    os.utime(tmp_path / 'data', (DATA_MTIME, DATA_MTIME))
+    subprocess.run(['tinydns-data'], cwd=tmp_path, check=True)
+    compare_cdb(tmp_path / 'data.cdb', FIXTURES / 'data.cdb')
+
+
+def test_every_entry_can_be_looked_up(tmp_path):
+    data = TinyDNSData(DATA_MTIME)
+    with open(FIXTURES / 'data', 'rb') as f:
+        for line in f:
+            data.add_line(line)
+    compile_fixture(tmp_path / 'compiled.cdb')
+
+    expected = {}
+    for key, value in data.entries:
+        expected.setdefault(key, []).append(value)
+    assert read_cdb(tmp_path / 'compiled.cdb') == expected
+
+
+@pytest.mark.parametrize('line, key, data', [
+    (
+        '+WWW.Example.piss:1.2.3.4:60',
+        b'\x03www\x07example\x04piss\x00',
+        b'\x00\x01=' + struct.pack('>L', 60) + b'\x00' * 8 + bytes([1, 2, 3, 4]),
+    ),
+    (
+        '+*.wild.piss:1.2.3.4',
+        b'\x04wild\x04piss\x00',
+        b'\x00\x01*' + struct.pack('>L', 86400) + b'\x00' * 8 + bytes([1, 2, 3, 4]),
+    ),
+    (
+        'Cwww.piss:piss.:60',
+        b'\x03www\x04piss\x00',
+        b'\x00\x05=' + struct.pack('>L', 60) + b'\x00' * 8 + b'\x04piss\x00',
+    ),
+    (
+        "'t.piss:a\\072b",
+        b'\x01t\x04piss\x00',
+        b'\x00\x10=' + struct.pack('>L', 86400) + b'\x00' * 8 + b'\x03a:b',
+    ),
+])
+def test_compile_line(line, key, data):
+    assert TinyDNSData(DATA_MTIME).compile_line(line) == [(key, data)]
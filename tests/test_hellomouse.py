@@ -0,0 +1,53 @@
+import asyncio
+import json
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from zonebot.hellomouse import HellomouseZoneBot, RRSet, ZoneTree
+from zonebot.validation import validate_zone
+
+# domains.json holds the zones as the API sends them, and <zone>/zone_data.json what the hellomouse backend wrote for
+# them before it built zones in a ZoneTree (apart from duplicate A, AAAA and NS values, which are now deduplicated)
+FIXTURES = Path(__file__).parent / 'fixtures' / 'hellomouse'
+DOMAINS = json.loads((FIXTURES / 'domains.json').read_text())
+
+
+@pytest.fixture
+def server(tmp_path):
+    config = SimpleNamespace(
+        ZONEFILE_LOCATION=str(tmp_path),
+        COREDNS_LOCATION=str(tmp_path),
+        IPV4_ADDR="1.1.1.1",
+        IPV6_ADDR="::1",
+        SOA_NS="ns1.pissnet.cc.",
+        SOA_EMAIL="hostmaster.piss.domains.",
+        NAMESERVERS=['a.piss.domains', 'b.piss.domains'],
+    )
+
+    async def make():
+        return HellomouseZoneBot(None, 'test', config, headless=True)
+    return asyncio.run(make())
+
+
+@pytest.mark.parametrize('domain', DOMAINS, ids=[domain['name'] for domain in DOMAINS])
+def test_zone_data_matches_fixture(server, tmp_path, domain):
+    server.pre_update(domain['name'], domain)
+    for record in validate_zone(domain, server.config)[0]:
+        server.insert_dns_record(domain['name'], *record)
+    server.post_update(domain['name'])
+
+    written = (tmp_path / domain['name'] / 'zone_data.json').read_text()
+    assert json.loads(written) == json.loads((FIXTURES / domain['name'] / 'zone_data.json').read_text())
+
+
+def test_to_zone_data_is_iterative():
+    # Far deeper than the recursion limit
+    tree = ZoneTree()
+    tree.node(['x'] * 5000).setdefault('TXT', RRSet()).add('bottom')
+
+    node = tree.to_zone_data()
+    for _ in range(5000):
+        node = node['child']['x']
+    assert node == {'TXT': {'type': 'static', 'data': [{'data': 'bottom'}]}}
@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+
+import pytest
+
+from zonebot.cdb import TinyDNSData
+from zonebot.validation import validate_zone
+
+CONFIG = SimpleNamespace(SOA_NS="ns1.pissnet.cc.", SOA_EMAIL="hostmaster.piss.domains.", NAMESERVERS=['a.piss.domains'])
+
+
+def validate(*records):
+    domain = {'name': 'test.piss', 'last_modified': '1', 'records': [
+        {'name': name, 'type': record_type, 'value': value} for name, record_type, value in records
+    ]}
+    return validate_zone(domain, CONFIG)
+
+
+@pytest.mark.parametrize('record, reason', [
+    (('a' * 64, 'A', '1.2.3.4'), "Label too long"),
+    (('ok.' + 'b' * 64, 'TXT', 'x'), "Label too long"),
+    (('.'.join(['c' * 50] * 5), 'A', '1.2.3.4'), "Name too long"),
+    (('www', 'CNAME', 'd' * 64 + '.example.'), "Label too long"),
+    (('sub', 'NS', 'e' * 64 + '.example.'), "Label too long"),
+    (('@', 'MX', '10 ' + 'f' * 64 + '.example.'), "Label too long"),
+])
+def test_names_that_dont_fit_in_dns_are_rejected(record, reason):
+    records, rejected = validate(record, ('ok', 'A', '1.2.3.4'))
+    assert [r for r, _ in rejected] == [reason]
+    assert records[-1].name == 'ok.test.piss'
+
+
+def test_accepted_records_compile():
+    # The longest names validation lets through still fit in tinydns-data's wire format
+    records, rejected = validate(('a' * 63, 'A', '1.2.3.4'), ('.'.join(['b' * 60] * 3) + '.ccc', 'TXT', 'x'))
+    assert not rejected
+    data = TinyDNSData(1)
+    for record in records:
+        data.add_line(f":{record.name}:16:x\n")
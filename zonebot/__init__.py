@@ -0,0 +1,40 @@
+import asyncio
+
+# The server of the first connection of every name, which does all the deploys. ircrobots creates a new server on
+# every reconnect, those hand their triggers over to it, so deploys never overlap and the periodic deploys run once.
+_deployers = {}
+
+
+def get_server_class(dns_server: str):
+    """ The BaseZoneBot subclass for a DNS_SERVER config value, only importing the backend that is used """
+    if dns_server == 'powerdns':
+        from .powerdns import PowerDNSZoneBot
+        return PowerDNSZoneBot
+    elif dns_server == 'tinydns':
+        from .tinydns import TinyDNSZoneBot
+        return TinyDNSZoneBot
+    elif dns_server == 'hellomouse':
+        from .hellomouse import HellomouseZoneBot
+        return HellomouseZoneBot
+    raise ValueError(f"Unknown DNS_SERVER {dns_server!r}")
+
+
+def create_server(bot, name: str, config, headless=False):
+    """ The server for the first backend in DNS_SERVER, deploying to the other ones through headless mirrors """
+    dns_servers = [config.DNS_SERVER] if isinstance(config.DNS_SERVER, str) else config.DNS_SERVER
+    server_class, *mirror_classes = [get_server_class(dns_server) for dns_server in dns_servers]
+    server = server_class(bot, name, config, headless)
+    if headless:
+        server.mirrors = [cls(None, f"{name}-{cls.dns_server}", config, headless=True) for cls in mirror_classes]
+        return server
+
+    deployer = _deployers.get(name)
+    if deployer is not None:
+        # A reconnect
+        server.scheduler = deployer.scheduler
+        server.mirrors = deployer.mirrors
+        return server
+    server.mirrors = [cls(None, f"{name}-{cls.dns_server}", config, headless=True) for cls in mirror_classes]
+    _deployers[name] = server
+    asyncio.get_event_loop().create_task(server.periodic_bg_task())
+    return server
@@ -1,27 +1,98 @@
 import asyncio
+import functools
 import hashlib
-import re
+import json
+import logging
+import os
 import subprocess
-from ipaddress import IPv4Address, AddressValueError, IPv6Address
+import re
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Optional
 
 import aiohttp
 from irctokens import build, Line
 from ircrobots import Server as BaseServer
 
+from .logs import deploy_log, irc_log
+from .metrics import metrics
+from .scheduler import DeployScheduler
+from .snapshot import SnapshotWriter, load_latest_snapshot
+from .stream import PayloadParser, ZoneFeed, iterate
+from .utils import atomic_open
+from .validation import ValidatedZone, validate_zone, zone_digest
+
+
+# Recent changes line of the wiki for a domain page, e.g. "\00314[[\00307Domain:Example.piss\00314]]\0034 ..."
+_wiki_domain_edit = re.compile(r"^\x0314\[\[\x0307Domain:([^\x03\]/|#]+)")
+# How much of the payload is read and parsed at a time
+_CHUNK_SIZE = 1 << 16
+
+
+class _PayloadUnchanged(Exception):
+    """ Stops the download of a payload we already deployed """
+
 
 class BaseZoneBot(BaseServer):
     pingcount = 0
+    # The DNS_SERVER value of the backend
+    dns_server = None
 
-    def __init__(self, bot, name: str, config):
+    def __init__(self, bot, name: str, config, headless=False):
         super().__init__(bot, name)
         self.config = config
-        loop = asyncio.get_event_loop()
-        loop.create_task(self.periodic_bg_task())
+        # One-shot deploys without IRC: no periodic deploys, and messages go to stdout
+        self.headless = headless
+        self.api_url = getattr(config, 'API_URL', "https://api.shitposting.space/piss/dns")
+        # Where to fetch a single zone, with {zone} in it, for the deploys of wiki edits (optional)
+        self.api_zone_url = getattr(config, 'API_ZONE_URL', None)
+        self.api_timeout = aiohttp.ClientTimeout(
+            total=None,
+            connect=getattr(config, 'API_CONNECT_TIMEOUT', 10),
+            sock_read=getattr(config, 'API_READ_TIMEOUT', 30),
+        )
+        # Kept around between polls so the connection to the API stays alive
+        self.session = None
+        # Validators of the last payload we deployed, for conditional requests
+        self.api_etag = None
+        self.api_last_modified = None
+        # The payload is parsed and validated here while it comes in, and the backends take the zones in their own
+        # thread, so deploys don't block the IRC connection
+        self.parse_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"parse-{name}")
+        self.deploy_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"deploy-{name}")
+        # Number of zones processed at the same time during a deploy
+        self.deploy_concurrency = getattr(config, 'DEPLOY_CONCURRENCY', 1)
+        # Digest of the records of every zone we deployed, by zone name, to skip zones whose content didn't change
+        self.zone_digests_file = getattr(config, 'ZONE_DIGESTS_FILE', "zone_digests.json")
+        if not isinstance(getattr(config, 'DNS_SERVER', ''), str):
+            # Every backend keeps track of its own zones
+            root, ext = os.path.splitext(self.zone_digests_file)
+            self.zone_digests_file = f"{root}.{self.dns_server}{ext}"
+        try:
+            with open(self.zone_digests_file, 'r') as f:
+                self.zone_digests = json.load(f)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            self.zone_digests = {}
+        # The last few payloads we deployed, to serve them again right after a restart, whether the API is up or not
+        self.snapshot_dir = getattr(config, 'SNAPSHOT_DIR', "snapshots")
+        self.snapshot_keep = getattr(config, 'SNAPSHOT_KEEP', 5)
+        # Whether a full deploy went through since we started. Until then the backends don't know all the zones, and
+        # a partial deploy could drop the ones it doesn't contain.
+        self.synced = False
+        # Other backends that get the same payload, they have no IRC connection of their own (see create_server)
+        self.mirrors: list[BaseZoneBot] = []
+        # Everything that wants a deploy goes through here, so deploys never overlap (see create_server for reconnects)
+        self.scheduler = DeployScheduler(self.update_dns, getattr(config, 'DEPLOY_DEBOUNCE', 5))
 
     async def periodic_bg_task(self):
+        # Serve what we had before the restart right away, then catch up with the API
+        if self.snapshot_dir:
+            await self.deploy_snapshot()
+        self.scheduler.trigger("startup")
         while True:
             await asyncio.sleep(300)  # 5 mins
-            await self.update_dns()
+            self.scheduler.trigger("periodic")
 
     async def msg(self, line_or_channel, msg):
         if not isinstance(line_or_channel, str):
@@ -30,17 +101,25 @@ class BaseZoneBot(BaseServer):
                 source = line_or_channel.hostmask.nickname
         else:
             source = line_or_channel
-        await self.send(build("PRIVMSG", [source, msg]))
+        if self.headless:
+            irc_log.info("%s: %s", source, msg)
+            return
+        # Deploys keep running on the server of the first connection, send through the current one. Without waiting
+        # for it to go out, it never does if the connection is lost.
+        self.bot.servers.get(self.name, self).send(build("PRIVMSG", [source, msg]))
 
     async def line_read(self, line: Line):
-        print(f"{self.name} < {line.format()}")
+        if irc_log.isEnabledFor(logging.DEBUG):
+            irc_log.debug("%s < %s", self.name, line.format())
         if line.command == "001":
             await self.send(build("JOIN", ["#pisswiki,#pissdns"]))
         elif line.command == "PRIVMSG":
             message = line.params[-1].strip()
             if line.hostmask.nickname == "Pisswiki":  # TODO: Validate that Pisswiki is the real one?
                 if message.startswith("\00314[[\00307Domain:"):
-                    await self.update_dns()
+                    # Only deploy the zone that got edited, the periodic deploys catch anything this misses
+                    edit = _wiki_domain_edit.match(message)
+                    self.scheduler.trigger("pisswiki", zone=edit.group(1).lower() if edit else None)
 
             if not message.startswith("!"):
                 return
@@ -53,7 +132,26 @@ class BaseZoneBot(BaseServer):
                 tag = subprocess.check_output(['git', 'describe', '--always', '--dirty']).decode().strip()
                 await self.msg(line, f"Version: \002{tag}\002 ({ver_date})")
             elif command == "force_update":
-                await self.update_dns(force=True)
+                self.scheduler.trigger("force_update", force=True)
+            elif command == "stats":
+                await self.msg(line, self.stats())
+
+    def stats(self) -> str:
+        deploys = metrics.get('zonebot_deploy_seconds_count', backend=self.dns_server)
+        average = metrics.get('zonebot_deploy_seconds_sum', backend=self.dns_server) / deploys if deploys else 0
+        latencies = [latency for _, latency in self.scheduler.latencies]
+        return (
+            f"Deploys: \002{deploys:g}\002 (avg {average:.1f}s), "
+            f"fetches: {metrics.get('zonebot_fetches_total', result='ok'):g} full / "
+            f"{metrics.get('zonebot_fetches_total', result='not_modified'):g} not modified / "
+            f"{metrics.get('zonebot_fetches_total', result='error'):g} failed, "
+            f"zones: {metrics.get('zonebot_zones_total', result='updated', backend=self.dns_server):g} updated / "
+            f"{metrics.get('zonebot_zones_total', result='skipped', backend=self.dns_server):g} skipped, "
+            f"records: {metrics.get('zonebot_records_accepted_total'):g} accepted / "
+            f"{metrics.get('zonebot_records_rejected_total'):g} rejected, "
+            f"DB queries: {metrics.get('zonebot_db_queries_total'):g}, "
+            f"max trigger latency: {max(latencies, default=0):.1f}s"
+        )
 
     def insert_dns_record(self, domain_id, name, record_type, content, prio=0, ttl=3600):
         raise NotImplementedError
@@ -63,9 +161,13 @@ class BaseZoneBot(BaseServer):
         raise NotImplementedError
 
     def needs_updating(self, domain_id, last_modified: int) -> bool:
-        """ Whether we should update this zone or not """
+        """ Whether we should update this zone or not, for zones we don't know the digest of yet """
         raise NotImplementedError
 
+    def has_zone(self, domain_id) -> bool:
+        """ Whether the zone is present on the DNS server, so it can be skipped when its content didn't change """
+        return True
+
     def pre_update(self, domain_id, domain_data):
         """ Executed just before we start inserting records for a domain we are going to update. """
         raise NotImplementedError
@@ -78,12 +180,113 @@ class BaseZoneBot(BaseServer):
         """ Executed before inserting any records at all """
         pass
 
-    async def update_dns(self, force=False):
-        async with aiohttp.ClientSession() as session:
-            async with session.get("https://api.shitposting.space/piss/dns") as resp:
-                raw_data = await resp.read()
-                data = await resp.json()
+    def post_db_update(self):
+        """ Executed after all zones have been processed, e.g. to reload the DNS server once (Optional) """
+        pass
+
+    def prepare_zones(self, zone_names: list, partial=False):
+        """ Executed with the names of the zones to deploy, before they are processed (Optional)
 
+        The zones come in batches while the payload is streamed, each of them with partial set. Unless the deploy
+        itself is partial, it is called once more at the end without partial, with all the zones in the payload: the
+        other ones are gone.
+        """
+        pass
+
+    def _api_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=self.api_timeout)
+        return self.session
+
+    def _conditional_headers(self, force=False) -> dict:
+        """ Lets the API answer 304 when the payload didn't change since the last deploy """
+        headers = {}
+        if not force:
+            if self.api_etag:
+                headers['If-None-Match'] = self.api_etag
+            if self.api_last_modified:
+                headers['If-Modified-Since'] = self.api_last_modified
+        return headers
+
+    async def fetch_dns_data(self, force=False):
+        """ Returns the raw API payload and its response headers, or None if it didn't change since the last deploy """
+        async with self._api_session().get(self.api_url, headers=self._conditional_headers(force)) as resp:
+            if resp.status == 304:
+                return None
+            resp.raise_for_status()
+            return await resp.read(), resp.headers
+
+    async def fetch_zone_data(self, zone_name: str):
+        """ Returns the raw API data of a single zone from API_ZONE_URL, or None if the API doesn't know it """
+        async with self._api_session().get(self.api_zone_url.format(zone=zone_name)) as resp:
+            if resp.status == 404:
+                return None
+            resp.raise_for_status()
+            return await resp.read()
+
+    async def update_dns(self, force=False, zones: Optional[set[str]] = None):
+        """ Deploys the API payload while it downloads, if it changed. With zones, only those zones get deployed. """
+        if not all(backend.synced for backend in [self, *self.mirrors]):
+            zones = None
+        if zones and self.api_zone_url:
+            await self.update_zones(zones)
+            return
+
+        # The zones were just edited, don't let a stale validator hide that
+        headers = self._conditional_headers(force or bool(zones))
+        try:
+            async with self._api_session().get(self.api_url, headers=headers) as resp:
+                if resp.status == 304:
+                    metrics.inc('zonebot_fetches_total', result='not_modified')
+                    return
+                resp.raise_for_status()
+                with metrics.timer('zonebot_fetch_seconds'):
+                    await self.deploy_stream(resp.content.iter_chunked(_CHUNK_SIZE), resp.headers, force, zones)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            metrics.inc('zonebot_fetches_total', result='error')
+            deploy_log.warning("Could not fetch the DNS data: %r", e)
+            return
+        metrics.inc('zonebot_fetches_total', result='ok')
+
+    async def update_zones(self, zones: set[str]):
+        """ Fetches and deploys just these zones through API_ZONE_URL """
+        domains = []
+        source = hashlib.sha1()
+        for zone_name in sorted(zones):
+            try:
+                with metrics.timer('zonebot_fetch_seconds'):
+                    raw_data = await self.fetch_zone_data(zone_name)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.inc('zonebot_fetches_total', result='error')
+                deploy_log.warning("Could not fetch the DNS data of %s: %r", zone_name, e)
+                return
+            metrics.inc('zonebot_fetches_total', result='ok')
+            if raw_data is None:
+                # Deleted or renamed, only a full deploy can tell
+                deploy_log.info("Zone %s not found, doing a full deploy", zone_name)
+                await self.update_dns(force=True)
+                return
+            source.update(raw_data)
+            domains.append(json.loads(raw_data))
+
+        loop = asyncio.get_running_loop()
+        validated = await loop.run_in_executor(self.parse_executor, self.validate, domains)
+        start = time.monotonic()
+        results = await self.deploy_domains(iterate(validated), partial=True, description=', '.join(sorted(zones)))
+        await self.report_deploy(results, source.hexdigest()[:10], start)
+
+    async def deploy_payload(self, raw_data: bytes, headers, force=False, zones: Optional[set[str]] = None):
+        """ Deploys a raw API payload, unless it's the one we already deployed. With zones, only deploys those zones. """
+        chunks = (raw_data[i:i + _CHUNK_SIZE] for i in range(0, len(raw_data), _CHUNK_SIZE))
+        await self.deploy_stream(iterate(chunks), headers, force, zones)
+
+    async def deploy_stream(self, chunks: AsyncIterator[bytes], headers, force=False,
+                            zones: Optional[set[str]] = None):
+        """ Deploys the API payload chunk by chunk while it comes in, unless it's the one we already deployed.
+
+        With zones, only deploys those zones. A last_modified field before the domains stops an unchanged payload
+        early, a later one once all the zones came in.
+        """
         # check if the data is newer than what we already got...
         last_data = ''
         try:
@@ -92,138 +295,353 @@ class BaseZoneBot(BaseServer):
         except FileNotFoundError:
             pass  # first run
 
-        if not force and data['last_modified'] == last_data:
-            return
-        print("Fresh data, updating...")
-        souce_hash = hashlib.sha1(raw_data).hexdigest()[:10]
-        await self.msg("#pissdns", f"Deploying zone. Source hash: \002{souce_hash}\002.")
-        self.pre_db_update()
-
-        # Start inserting the new stuff
-        for dom in data['domains']:
-            print(f"Updating {dom['name']}... ")
-            # Check if domain exists.
-
-            domain_id = self.get_zone(dom['name'])
-
-            if not self.needs_updating(domain_id, dom['last_modified']):
-                print("  - Skipping, not modified")
-                continue
-
-            self.pre_update(domain_id, dom)
-
-            self.insert_dns_record(
-                domain_id=domain_id,
-                name=dom['name'],
-                record_type='SOA',
-                content=f"{self.config.SOA_NS} {self.config.SOA_EMAIL} {dom['last_modified']} 300 60 691200 3600",
-                ttl=7200
-            )
-
-            self.insert_dns_record(
-                domain_id=domain_id,
-                name=dom['name'],
-                record_type='TXT',
-                content=f"Zone managed by the pissnet wiki DNS system. "
-                        f"Contact #pisswiki on ircs://irc.letspiss.net/#pisswiki for abuse with full logs.",
-                ttl=300
-            )
-
-            for ns in self.config.NAMESERVERS:
-                self.insert_dns_record(
-                    domain_id=domain_id,
-                    name=dom['name'],
-                    record_type='NS',
-                    content=ns
-                )
-
-            records_to_insert = []
-            domains_with_cnames = []
-
-            # Insert dem records
-            for rec in dom['records']:
-                # Ignore invalid stuff
-                if rec['type'] not in ('A', 'AAAA', 'CNAME', 'TXT', 'NS', 'CAA', 'MX'):
+        loop = asyncio.get_running_loop()
+        parser = PayloadParser()
+        source = hashlib.sha1()
+        # Top level fields of the payload, and the ones of them that came before the domains
+        fields = {}
+        leading_fields = {}
+        found = set()
+        parse_time = 0.0
+        # The payload goes to disk as it comes in, it only becomes a snapshot if the deploy works out
+        snapshot = None
+        if self.snapshot_dir and not zones:
+            try:
+                snapshot = SnapshotWriter(self.snapshot_dir)
+            except OSError as e:
+                deploy_log.warning("Could not save a snapshot: %r", e)
+
+        def parse(chunk: bytes, final=False) -> list[ValidatedZone]:
+            # Runs in the parse thread, the zones it returns are ready for the backends
+            nonlocal parse_time
+            source.update(chunk)
+            if snapshot is not None:
+                snapshot.write(chunk)
+            start = time.monotonic()
+            events = parser.feed(chunk, final)
+            parse_time += time.monotonic() - start
+
+            validated = []
+            for key, value in events:
+                if key != 'domains':
+                    fields[key] = value
+                    if not found:
+                        leading_fields[key] = value
                     continue
+                found.add(value['name'].lower())
+                if not zones or value['name'].lower() in zones:
+                    validated.append(self.validate_domain(value))
+            return validated
+
+        async def validated_zones():
+            async for chunk in chunks:
+                validated = await loop.run_in_executor(self.parse_executor, parse, chunk)
+                if not zones and not force and leading_fields.get('last_modified') == last_data:
+                    raise _PayloadUnchanged()
+                for zone in validated:
+                    yield zone
+            for zone in await loop.run_in_executor(self.parse_executor, parse, b'', True):
+                yield zone
 
-                prio = 0
+        try:
+            start = time.monotonic()
+            try:
+                results = await self.deploy_domains(
+                    validated_zones(), partial=bool(zones), description=', '.join(sorted(zones)) if zones else None,
+                    unchanged=lambda: not zones and not force and fields.get('last_modified') == last_data, force=force
+                )
+                if not results and not zones:
+                    raise _PayloadUnchanged()
+            except _PayloadUnchanged:
+                self.api_etag, self.api_last_modified = headers.get('ETag'), headers.get('Last-Modified')
+                return
+            metrics.observe('zonebot_parse_seconds', parse_time)
+            souce_hash = source.hexdigest()[:10]
+            if not await self.report_deploy(results, souce_hash, start, force):
+                return  # Try again next time, the backends that succeeded will skip the zones they already have
+
+            if zones:
+                if not zones <= found:
+                    # Deleted or renamed, only a full deploy can tell
+                    deploy_log.info("Not all of %s found, doing a full deploy", ', '.join(sorted(zones)))
+                    await self.update_dns(force=True)
+                return
 
-                # Validations:
-                if len(rec['value']) > 255:
-                    print(f"Got an invalid record! (Value too long) {rec}")
-                    continue
+            with open("last_data_ts", 'w') as f:
+                f.write(fields.get('last_modified', ''))
+            self.api_etag, self.api_last_modified = headers.get('ETag'), headers.get('Last-Modified')
+
+            if snapshot is not None:
+                try:
+                    await loop.run_in_executor(
+                        self.parse_executor, snapshot.commit, souce_hash, dict(self.zone_digests), self.snapshot_keep
+                    )
+                except OSError as e:
+                    deploy_log.warning("Could not save a snapshot: %r", e)
+        finally:
+            if snapshot is not None:
+                snapshot.discard()
+
+    async def deploy_snapshot(self):
+        """ Deploys the latest snapshot, without waiting for the API.
+
+        It is deployed like a partial deploy, so zones that were added since are kept until the next full deploy. The
+        backends only take the zones they don't have, see snapshot_zones().
+        """
+        loop = asyncio.get_running_loop()
+        snapshot = await loop.run_in_executor(self.parse_executor, load_latest_snapshot, self.snapshot_dir)
+        if snapshot is None:
+            return
+        try:
+            validated = await loop.run_in_executor(self.parse_executor, self.validate, snapshot['payload']['domains'])
+        except Exception as e:
+            deploy_log.error("Deploy of snapshot %s failed: %r", snapshot['path'], e)
+            return
 
-                if rec['type'] == 'A':
-                    try:
-                        IPv4Address(rec['value'])
-                    except AddressValueError:
-                        print(f"Got an invalid record! (Bad IPv4) {rec}")
-                        continue
-                elif rec['type'] == 'AAAA':
-                    try:
-                        IPv6Address(rec['value'])
-                    except AddressValueError:
-                        print(f"Got an invalid record! (Bad IPv6) {rec}")
-                        continue
-                elif rec['type'] in ('CNAME', 'NS'):
-                    if not re.match(r"^[a-zA-Z0-9.-_]+$", rec['value']):
-                        print(f"Got an invalid record! (Bad value) {rec}")
-                        continue
-                elif rec['type'] == 'CAA':
-                    if not re.match(r"^(\d{1,3}) ([a-z0-9]+) \"([a-zA-Z0-9\-._@:;/= ]+)\"$", rec['value']):
-                        print(f"Got an invalid record! (Bad value) {rec}")
-                        continue
-                elif rec['type'] == 'MX':
-                    splt = rec['value'].split(" ")
-                    if len(splt) == 2:  # We got a prio!
-                        prio = splt[0]
-                        rec['value'] = splt[1]
-                    elif len(splt) > 2:
-                        print(f"Got an invalid record! (Bad value) {rec}")
-                        continue
-
-                if rec['name'] == '@' and rec['type'] in ('CNAME', 'NS'):
-                    print(f"Got an invalid record! (CNAME or NS on root not allowed) {rec}")
-                    continue
+        deploys = {}
+        for backend in [self, *self.mirrors]:
+            zones = backend.snapshot_zones(validated)
+            if zones:
+                deploys[backend] = zones
+        if not deploys:
+            return
+        deploy_log.info("Deploying snapshot %s", snapshot['path'])
+        await self.msg("#pissdns", "Deploying snapshot.")
+        start = time.monotonic()
+        results = await asyncio.gather(
+            *(loop.run_in_executor(backend.deploy_executor, backend.deploy, zones, True, True)
+              for backend, zones in deploys.items()),
+            return_exceptions=True
+        )
+        await self.report_deploy(list(zip(deploys, results)), snapshot['source_hash'], start)
+
+    def snapshot_zones(self, zones: list[ValidatedZone]) -> list[ValidatedZone]:
+        """ The zones of a snapshot to deploy at startup
+
+        Only the zones the DNS server doesn't have are deployed (see deploy_zone), the others may have been deployed
+        again since the snapshot was taken, e.g. by a wiki edit, and the snapshot would roll them back.
+        """
+        return zones
+
+    async def deploy_domains(self, zones: AsyncIterator[ValidatedZone], partial=False,
+                             description: Optional[str] = None,
+                             unchanged: Optional[Callable[[], bool]] = None,
+                             force=False) -> list[tuple["BaseZoneBot", object]]:
+        """ Deploys the zones to every backend as they come in.
+
+        Returns what each backend ended up with: the number of zones it updated and skipped, or the exception it failed
+        with. A partial deploy only contains some of the zones, the others are left alone. If the zones fail to come
+        in, the backends stop where they are and the error is raised.
+
+        Once all the zones came in without any of them changing, unchanged() can still tell there is nothing to deploy,
+        e.g. from a field after the domains. The backends then stop where they are, and nothing is returned. Forced
+        deploys are always announced and go through.
+        """
+        # The backends do blocking I/O, keep it away from the IRC connection. Every backend has its own thread, and
+        # takes the zones from a feed so a slow one doesn't hold the others up for more than the size of its feed.
+        loop = asyncio.get_running_loop()
+        backends = [self, *self.mirrors]
+        feeds: list[ZoneFeed] = []
+        futures = []
+        # Unless forced, only announced once a zone changed, polls of the same payload stay quiet
+        announced = False
+
+        async def announce():
+            nonlocal announced
+            announced = True
+            await self.msg("#pissdns", f"Deploying {description or 'zone'}.")
+
+        def start():
+            for backend in backends:
+                feeds.append(ZoneFeed())
+                futures.append(loop.run_in_executor(backend.deploy_executor, backend.deploy, feeds[-1], partial))
+
+        async def stop():
+            for feed in feeds:
+                feed.abort()
+            await asyncio.gather(*futures, return_exceptions=True)
 
-                # Name must be valid dns
-                if not re.match(r"^[a-zA-Z0-9._-]+$", rec['name']) and rec['name'] != '@':
-                    print(f"Got an invalid record! (Bad label) {rec}")
-                    continue
+        try:
+            async for zone in zones:
+                if not futures:
+                    start()
+                name = zone.domain['name']
+                if not announced and (force or any(backend.zone_digests.get(name) != zone.digest
+                                                   for backend in backends)):
+                    await announce()
+                for feed, future in zip(feeds, futures):
+                    await feed.put(zone, future)
+        except BaseException as e:
+            if futures:
+                await stop()
+                deploy_log.error("Deploy failed: %r", e)
+                if announced:
+                    await self.msg("#pissdns", f"Deploy of {description or 'zone'} failed: {e!r}")
+            raise
+
+        if not futures and not partial:
+            # Nothing at all is worth telling about
+            await announce()
+            start()
+        if not announced and unchanged is not None and unchanged():
+            await stop()
+            return []
+        for feed, future in zip(feeds, futures):
+            await feed.close(future)
+        return list(zip(backends, await asyncio.gather(*futures, return_exceptions=True)))
+
+    async def report_deploy(self, results: list, souce_hash: str, start: float, force=False) -> bool:
+        """ Reports the results of deploy_domains, returns whether all backends succeeded.
+
+        Deploys that didn't change anything anywhere are only logged, unless they were forced from IRC.
+        """
+        duration = time.monotonic() - start
+        if not force and all(not isinstance(result, Exception) and result[0] == 0 for _, result in results):
+            deploy_log.info("Deployed %s: no zones updated (%.1fs)", souce_hash, duration)
+            return True
+
+        failed = False
+        for backend, result in results:
+            target = f" to {backend.dns_server}" if self.mirrors else ""
+            if isinstance(result, Exception):
+                failed = True
+                deploy_log.error("Deploy%s failed: %r", target, result)
+                await self.msg("#pissdns", f"Deploy of \002{souce_hash}\002{target} failed: {result!r}")
+            else:
+                updated, skipped = result
+                await self.msg(
+                    "#pissdns",
+                    f"Deployed \002{souce_hash}\002{target}: {updated} zones updated, {skipped} unchanged "
+                    f"({duration:.1f}s)."
+                )
+        return not failed
+
+    def validate_domain(self, dom: dict) -> ValidatedZone:
+        """ Validates a domain once for every backend, reporting its rejected records if the zone changed.
+
+        The report is a single line with the number of rejected records for each reason, the records themselves are
+        only logged at the DEBUG level.
+        """
+        with metrics.timer('zonebot_validate_seconds'):
+            records, rejected = validate_zone(dom, self.config)
+            zone = ValidatedZone(dom, records, rejected, zone_digest(records))
+        if self.zone_digests.get(dom['name']) == zone.digest:
+            return zone
+
+        metrics.inc('zonebot_records_accepted_total', len(records))
+        if rejected:
+            reasons = Counter(reason for reason, _ in rejected)
+            for reason, count in reasons.items():
+                metrics.inc('zonebot_records_rejected_total', count, reason=reason)
+            deploy_log.warning("Rejected %d record(s) of %s (%s)", len(rejected), dom['name'],
+                               ", ".join(f"{reason}: {count}" for reason, count in reasons.most_common()))
+            if deploy_log.isEnabledFor(logging.DEBUG):
+                for reason, rec in rejected:
+                    deploy_log.debug("Invalid record in %s (%s): %s", dom['name'], reason, rec)
+        return zone
+
+    def validate(self, domains: list) -> list[ValidatedZone]:
+        return [self.validate_domain(dom) for dom in domains]
+
+    def deploy(self, zones, partial=False, missing_only=False) -> tuple[int, int]:
+        """ Pushes the zones, a list or a ZoneFeed, to the DNS server. Blocking, so it runs in the deploy thread.
+
+        With missing_only, zones the DNS server already has are left as they are. Returns the number of zones that
+        were updated and skipped.
+        """
+        with metrics.timer('zonebot_deploy_seconds', backend=self.dns_server):
+            updated, skipped = self._deploy(zones, partial, missing_only)
+        metrics.set('zonebot_last_deploy_timestamp_seconds', time.time(), backend=self.dns_server)
+        return updated, skipped
+
+    def _deploy(self, zones, partial=False, missing_only=False) -> tuple[int, int]:
+        self.pre_db_update()
 
-                rec_name = f"{rec['name']}.{dom['name']}" if rec['name'] != "@" else dom['name']
-                if len(rec_name) > 255:
-                    print(f"Got an invalid record! (Name too long) {rec}")
-                    continue
+        # Zones don't depend on each other, so they can be processed in parallel
+        pool = None
+        if self.deploy_concurrency > 1:
+            pool = ThreadPoolExecutor(self.deploy_concurrency, thread_name_prefix=f"zone-{self.name}")
+        names = []
+        results = []
+        try:
+            for batch in zones.batches(100) if isinstance(zones, ZoneFeed) else [list(zones)]:
+                batch_names = [zone.domain['name'] for zone in batch]
+                names.extend(batch_names)
+                self.prepare_zones(batch_names, partial=True)
+                if pool is not None:
+                    results.extend(pool.map(functools.partial(self.deploy_zone, missing_only=missing_only), batch))
+                else:
+                    results.extend(self.deploy_zone(zone, missing_only) for zone in batch)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        if not partial:
+            # Now we know all the zones, and which ones are gone
+            self.prepare_zones(names)
+
+        self.post_db_update()
+
+        # Forget about the zones that are gone
+        if not partial:
+            names = set(names)
+            self.zone_digests = {name: digest for name, digest in self.zone_digests.items() if name in names}
+        with atomic_open(self.zone_digests_file, 'w') as f:
+            json.dump(self.zone_digests, f)
+
+        self.synced = self.synced or not partial
+        updated = sum(results)
+        return updated, len(results) - updated
+
+    def dry_run(self, domains: list) -> list[str]:
+        """ Validates the domains and compares them to what we deployed last, without touching the DNS server.
+
+        Returns the lines of a report of what a deploy would do.
+        """
+        report = []
+        changed = 0
+        for dom in domains:
+            records, rejected = validate_zone(dom, self.config)
+            known_digest = self.zone_digests.get(dom['name'])
+            if known_digest == zone_digest(records):
+                continue
+            changed += 1
+            status = "not tracked yet" if known_digest is None else "changed"
+            report.append(f"{dom['name']}: {status}, {len(records)} records, {len(rejected)} rejected")
+            report.extend(f"  - {reason}: {rec}" for reason, rec in rejected)
+        report.append(f"{changed} zones to update, {len(domains) - changed} unchanged")
+        return report
+
+    def deploy_zone(self, zone: ValidatedZone, missing_only=False) -> bool:
+        """ Pushes a single zone to the DNS server, returns whether it had to be updated """
+        dom = zone.domain
+        deploy_log.debug("Updating %s...", dom['name'])
+        # Check if domain exists.
+
+        domain_id = self.get_zone(dom['name'])
+
+        if missing_only and self.has_zone(domain_id):
+            # What the DNS server has may be newer, and we can't tell: leave it alone, digest included
+            deploy_log.debug("Skipping %s, already there", dom['name'])
+            metrics.inc('zonebot_zones_total', result='skipped', backend=self.dns_server)
+            return False
+
+        known_digest = self.zone_digests.get(dom['name'])
+        if known_digest is None:
+            changed = self.needs_updating(domain_id, dom['last_modified'])
+        else:
+            changed = known_digest != zone.digest or not self.has_zone(domain_id)
 
-                if rec['type'] == "CNAME":
-                    domains_with_cnames.append(rec_name)
-
-                records_to_insert.append({
-                    'domain_id': domain_id,
-                    'name': rec_name,
-                    'record_type': rec['type'],
-                    'content': rec['value'],
-                    'prio': prio,
-                    'ttl': 60  # TODO: Configurable TTL (wiki task)
-                })
-
-            domains_with_cnames_inserted = []
-            for record in records_to_insert:
-                # Check for CNAME violations
-                if record['name'] in domains_with_cnames:
-                    if record['record_type'] != "CNAME":
-                        print(f"Got a non-CNAME record for an entry that already has a CNAME! {record}")
-                        continue
-                    else:
-                        if record['name'] in domains_with_cnames_inserted:
-                            print(f"Got a CNAME record for an entry that already has a CNAME! {record}")
-                            continue
-                        domains_with_cnames_inserted.append(record['name'])
-
-                self.insert_dns_record(**record)
+        if not changed:
+            deploy_log.debug("Skipping %s, not modified", dom['name'])
+            metrics.inc('zonebot_zones_total', result='skipped', backend=self.dns_server)
+            self.zone_digests[dom['name']] = zone.digest
+            return False
 
+        with metrics.timer('zonebot_zone_write_seconds', backend=self.dns_server):
+            self.pre_update(domain_id, dom)
+            for record in zone.records:
+                self.insert_dns_record(domain_id, *record)
             self.post_update(domain_id)
-
-        with open("last_data_ts", 'w') as f:
-            f.write(data['last_modified'])
+        metrics.inc('zonebot_zones_total', result='updated', backend=self.dns_server)
+        self.zone_digests[dom['name']] = zone.digest
+        return True
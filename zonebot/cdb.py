@@ -0,0 +1,242 @@
+import ipaddress
+import re
+import struct
+import time
+
+# Default TTLs used by tinydns-data when a line doesn't specify one
+TTL_NS = 259200
+TTL_POSITIVE = 86400
+TTL_NEGATIVE = 2560
+
+DNS_T_A = b'\x00\x01'
+DNS_T_NS = b'\x00\x02'
+DNS_T_CNAME = b'\x00\x05'
+DNS_T_SOA = b'\x00\x06'
+DNS_T_PTR = b'\x00\x0c'
+DNS_T_MX = b'\x00\x0f'
+DNS_T_TXT = b'\x00\x10'
+DNS_T_AXFR = b'\x00\xfc'
+
+# Types tinydns-data refuses in generic (":") lines
+PROHIBITED_GENERIC_TYPES = (b'\x00\x00', DNS_T_SOA, DNS_T_NS, DNS_T_CNAME, DNS_T_PTR, DNS_T_MX, DNS_T_AXFR)
+
+NUMFIELDS = 15
+NO_TTD = b'\x00' * 8
+
+_leading_digits = re.compile(rb'\d+')
+
+
+def cdb_hash(key: bytes) -> int:
+    h = 5381
+    for c in key:
+        h = ((h << 5) + h ^ c) & 0xffffffff
+    return h
+
+
+class CDBMaker:
+    """ Writes a constant database (https://cr.yp.to/cdb/cdb.txt) to a seekable binary file, like cdb_make does """
+
+    def __init__(self, f):
+        self.f = f
+        self.pos = 2048
+        self.hashes = [[] for _ in range(256)]
+        f.seek(self.pos)
+
+    def add(self, key: bytes, data: bytes):
+        h = cdb_hash(key)
+        self.f.write(struct.pack('<LL', len(key), len(data)))
+        self.f.write(key)
+        self.f.write(data)
+        self.hashes[h & 255].append((h, self.pos))
+        self.pos += 8 + len(key) + len(data)
+
+    def finish(self):
+        header = []
+        for entries in self.hashes:
+            slots = [(0, 0)] * (len(entries) * 2)
+            for h, pos in entries:
+                where = (h >> 8) % len(slots)
+                while slots[where][1]:
+                    where = (where + 1) % len(slots)
+                slots[where] = (h, pos)
+            header.append(struct.pack('<LL', self.pos, len(slots)))
+            self.f.write(b''.join(struct.pack('<LL', h, pos) for h, pos in slots))
+            self.pos += 8 * len(slots)
+        self.f.seek(0)
+        self.f.write(b''.join(header))
+
+
+def scan_ulong(field: bytes, default: int) -> int:
+    """ Leading decimal digits of a field, or the default if there are none """
+    match = _leading_digits.match(field)
+    return int(match.group()) & 0xffffffff if match else default
+
+
+def unescape(field: bytes) -> bytes:
+    """ Undo the \\ooo octal escapes of a field, like txtparse in tinydns-data """
+    if b'\\' not in field:
+        return field
+    out = bytearray()
+    i = 0
+    while i < len(field):
+        ch = field[i]
+        i += 1
+        if ch == 0x5c:  # backslash
+            if i >= len(field):
+                break
+            ch = field[i]
+            i += 1
+            if 0x30 <= ch <= 0x37:
+                ch -= 0x30
+                for _ in range(2):
+                    if i < len(field) and 0x30 <= field[i] <= 0x37:
+                        ch = (ch << 3) + field[i] - 0x30
+                        i += 1
+                    else:
+                        break
+                ch &= 0xff
+        out.append(ch)
+    return bytes(out)
+
+
+def domain_fromdot(name: bytes) -> bytes:
+    """ Convert a dotted domain name into DNS wire format, like dns_domain_fromdot """
+    wire = bytearray()
+    label = bytearray()
+    i = 0
+    while i < len(name):
+        ch = name[i]
+        i += 1
+        if ch == 0x2e:  # dot
+            if label:
+                wire.append(len(label))
+                wire += label
+                label.clear()
+            continue
+        if ch == 0x5c:  # backslash
+            if i >= len(name):
+                break
+            ch = name[i]
+            i += 1
+            if 0x30 <= ch <= 0x37:
+                ch -= 0x30
+                for _ in range(2):
+                    if i < len(name) and 0x30 <= name[i] <= 0x37:
+                        ch = (ch << 3) + name[i] - 0x30
+                        i += 1
+                    else:
+                        break
+                ch &= 0xff
+        if len(label) >= 63:
+            raise ValueError(f"Label too long in {name!r}")
+        label.append(ch)
+    if label:
+        wire.append(len(label))
+        wire += label
+    wire.append(0)
+    if len(wire) > 255:
+        raise ValueError(f"Name too long: {name!r}")
+    return bytes(wire)
+
+
+class TinyDNSData:
+    """ Compiles tinydns-data lines into data.cdb in-process.
+
+    Only the line types written by TinyDNSZoneBot are supported (Z . & + : ' C @), with the same defaults as
+    tinydns-data, so lookups in the resulting data.cdb match what `tinydns-data` builds from the same text.
+    """
+
+    def __init__(self, default_serial: int = None):
+        if default_serial is None:
+            default_serial = int(time.time())  # tinydns-data uses the mtime of the data file
+        self.default_soa = struct.pack('>LLLLL', default_serial & 0xffffffff, 16384, 2048, 1048576, 2560)
+        self.entries: list[tuple[bytes, bytes]] = []
+
+    @staticmethod
+    def _rr(owner: bytes, record_type: bytes, ttl: int, rdata: bytes) -> tuple[bytes, bytes]:
+        # No location, no timestamp: '=' flag, TTL, 8 zero bytes of TTD
+        prefix = b'='
+        if owner.startswith(b'\x01*'):
+            owner = owner[2:]
+            prefix = b'*'
+        return owner.lower(), record_type + prefix + struct.pack('>L', ttl) + NO_TTD + rdata
+
+    def compile_line(self, line: str | bytes) -> list[tuple[bytes, bytes]]:
+        """ Returns the (key, data) entries a single line of tinydns data compiles to """
+        if isinstance(line, str):
+            line = line.encode()
+        line = line.rstrip(b' \t\n')
+        if not line or line[:1] in (b'#', b'-'):
+            return []
+
+        kind = line[:1]
+        f = line[1:].split(b':', NUMFIELDS - 1)
+        f += [b''] * (NUMFIELDS - len(f))
+        owner = domain_fromdot(f[0])
+
+        if kind == b'Z':
+            soa = struct.pack(
+                '>LLLLL', *(scan_ulong(f[3 + i], default) for i, default in enumerate(struct.unpack('>LLLLL', self.default_soa)))
+            )
+            ttl = scan_ulong(f[8], TTL_NEGATIVE)
+            return [self._rr(owner, DNS_T_SOA, ttl, domain_fromdot(f[1]) + domain_fromdot(f[2]) + soa)]
+
+        if kind in (b'.', b'&'):
+            ttl = scan_ulong(f[3], TTL_NS)
+            ns = f[2] if b'.' in f[2] else f[2] + b'.ns.' + f[0]
+            ns_wire = domain_fromdot(ns)
+            entries = []
+            if kind == b'.':
+                entries.append(self._rr(
+                    owner, DNS_T_SOA, TTL_NEGATIVE if ttl else 0, ns_wire + b'\x0ahostmaster' + owner + self.default_soa
+                ))
+            entries.append(self._rr(owner, DNS_T_NS, ttl, ns_wire))
+            if ip := self._ip4(f[1]):
+                entries.append(self._rr(ns_wire, DNS_T_A, ttl, ip))
+            return entries
+
+        if kind == b'+':
+            ip = self._ip4(f[1])
+            return [self._rr(owner, DNS_T_A, scan_ulong(f[2], TTL_POSITIVE), ip)] if ip else []
+
+        if kind == b'C':
+            return [self._rr(owner, DNS_T_CNAME, scan_ulong(f[2], TTL_POSITIVE), domain_fromdot(f[1]))]
+
+        if kind == b'@':
+            ttl = scan_ulong(f[4], TTL_POSITIVE)
+            mx = f[2] if b'.' in f[2] else f[2] + b'.mx.' + f[0]
+            mx_wire = domain_fromdot(mx)
+            entries = [self._rr(owner, DNS_T_MX, ttl, struct.pack('>H', scan_ulong(f[3], 0) & 0xffff) + mx_wire)]
+            if ip := self._ip4(f[1]):
+                entries.append(self._rr(mx_wire, DNS_T_A, ttl, ip))
+            return entries
+
+        if kind == b"'":
+            text = unescape(f[1])
+            rdata = b''.join(bytes((len(text[i:i + 127]),)) + text[i:i + 127] for i in range(0, len(text), 127))
+            return [self._rr(owner, DNS_T_TXT, scan_ulong(f[2], TTL_POSITIVE), rdata)]
+
+        if kind == b':':
+            record_type = struct.pack('>H', scan_ulong(f[1], 0) & 0xffff)
+            if record_type in PROHIBITED_GENERIC_TYPES:
+                raise ValueError(f"Prohibited type in generic record: {line!r}")
+            return [self._rr(owner, record_type, scan_ulong(f[3], TTL_POSITIVE), unescape(f[2]))]
+
+        raise ValueError(f"Unsupported tinydns data line: {line!r}")
+
+    @staticmethod
+    def _ip4(field: bytes) -> bytes:
+        try:
+            return ipaddress.IPv4Address(field.decode()).packed
+        except (ipaddress.AddressValueError, UnicodeDecodeError):
+            return b''
+
+    def add_line(self, line: str | bytes):
+        self.entries.extend(self.compile_line(line))
+
+    def write(self, f):
+        """ Write the compiled records as a cdb to a seekable binary file """
+        maker = CDBMaker(f)
+        for key, data in self.entries:
+            maker.add(key, data)
+        maker.finish()
@@ -1,17 +1,13 @@
 from typing import Literal, Optional, TypedDict
 from .base import BaseZoneBot
+from .logs import deploy_log
+from .metrics import metrics
+from .utils import atomic_open
 import json
 from os.path import exists
 from os import makedirs
 import subprocess
 
-def flatten(list_of_lists: list) -> list:
-    if len(list_of_lists) == 0:
-        return list_of_lists
-    if isinstance(list_of_lists[0], list):
-        return flatten(list_of_lists[0]) + flatten(list_of_lists[1:])
-    return list_of_lists[:1] + flatten(list_of_lists[1:])
-
 class CAARecord(TypedDict):
     flags: int
     tag: str
@@ -46,11 +42,56 @@ class ZoneData(TypedDict):
     zone: ZoneDataFormat
 
 
+class RRSet(dict):
+    """ The values of one record type at one name, in the order they were added and without duplicates """
+
+    def add(self, value):
+        self.setdefault(tuple(value.items()) if isinstance(value, dict) else value, value)
+
+
+class ZoneTree:
+    """ The records of a zone, by name and record type, before they get turned into the dnsdng format.
+
+    Every name is a dict of record type -> RRSet (or a single value, like the CNAME in 'ANY'), with the names below it
+    in 'child'. Keys keep the order they were added in, like in the final JSON.
+    """
+
+    def __init__(self):
+        self.root: dict = {}
+
+    def node(self, labels: list[str]) -> dict:
+        """ The node of a name, given its labels from the apex down (none for the apex itself) """
+        node = self.root
+        for label in labels:
+            node = node.setdefault('child', {}).setdefault(label, {})
+        return node
+
+    def to_zone_data(self) -> ZoneDataFormat:
+        """ Converts the tree into the dnsdng format, iteratively so deep names can't hit the recursion limit """
+        result = {}
+        stack = [(self.root, result)]
+        while stack:
+            node, out = stack.pop()
+            for key, value in node.items():
+                if key == 'child':
+                    children = out['child'] = {}
+                    for label, child in value.items():
+                        children[label] = {}
+                        stack.append((child, children[label]))
+                elif isinstance(value, RRSet):
+                    out[key] = {'type': 'static', 'data': [{'data': item} for item in value.values()]}
+                else:
+                    out[key] = value
+        return result
+
+
 class HellomouseZoneBot(BaseZoneBot):
-    def __init__(self, bot, name: str, config):
-        super().__init__(bot, name, config)
-        # List of records that accept multiple values, and thus are arrays in the data structure
-        self.arrayRecords = ['TXT', 'A', 'AAAA', 'MX', 'NS', 'SRV', 'SSHFP', 'URI', 'CAA']
+    dns_server = "hellomouse"
+
+    def __init__(self, bot, name: str, config, headless=False):
+        super().__init__(bot, name, config, headless)
+        # Records that accept multiple values, and thus are arrays in the data structure
+        self.arrayRecords = {'TXT', 'A', 'AAAA', 'MX', 'NS', 'SRV', 'SSHFP', 'URI', 'CAA'}
         self.corednsTemplate = '\n'.join([
             '{',
             '  grpc . 127.0.0.1:5353',
@@ -58,74 +99,58 @@ class HellomouseZoneBot(BaseZoneBot):
             f'  bind 127.0.0.1 ::1 {self.config.IPV4_ADDR} {self.config.IPV6_ADDR}',
             '}'
         ])
+        # Zones being updated, built in memory and written to disk once in post_update
+        self.zones: dict[str, ZoneData] = {}
+        # pm2 services to restart once the whole deploy is done
+        self.pending_restarts: set[str] = set()
+        # Zones in the current payload, and the Corefile contents we last saw on disk
+        self.served_zones: set[str] = set()
+        self.corefile: Optional[str] = None
 
     def pre_update(self, domain_id, domain_data):
-        # Avoid throwing NotImplementedError
-        pass
+        if not exists(f'{self.config.ZONEFILE_LOCATION}/{domain_id}/'):
+            deploy_log.debug('Creating directory for %s', domain_id)
+            makedirs(f'{self.config.ZONEFILE_LOCATION}/{domain_id}/', exist_ok=True)
+        self.zones[domain_id] = { 'last_modified': domain_data['last_modified'], 'zone': ZoneTree() }
     
     def pre_db_update(self):
         # Avoid throwing NotImplementedError
         pass
 
+    def prepare_zones(self, zone_names: list, partial=False):
+        if partial:
+            if self.corefile is None:
+                # Right after a restart, keep serving the zones that are in the Corefile already
+                self._read_corefile()
+                self.served_zones.update(
+                    line.split(' ', 1)[0] for line in self.corefile.splitlines() if line.endswith(' {')
+                )
+            self.served_zones.update(zone_names)
+        else:
+            self.served_zones = set(zone_names)
+
     def get_zone(self, zone_name: str) -> str:
         return zone_name
 
     def needs_updating(self, domain_id: str, last_modified: int) -> bool:
-        # Check if the zone's directory exists (there isn't a better place to put this)
-        if not exists(f'{self.config.ZONEFILE_LOCATION}/{domain_id}/'):
-            print(f'Creating directory for {domain_id}')
-            makedirs(f'{self.config.ZONEFILE_LOCATION}/{domain_id}/', exist_ok=True)
-
         # Check if we need to update records by comparing the timestamp in the SOA record
         try:
             with open(f'{self.config.ZONEFILE_LOCATION}/{domain_id}/zone_data.json', 'r') as f:
                 data = json.load(f)
-                if data['last_modified'] != last_modified:
-                    return True
+                return data['last_modified'] != last_modified
         except (FileNotFoundError, json.decoder.JSONDecodeError, KeyError):
-            data = { 'last_modified': last_modified, 'zone': {} }
-            with open(f'{self.config.ZONEFILE_LOCATION}/{domain_id}/zone_data.json', 'w+') as f:
-                json.dump(data, f, indent=2)
-                print(f'Created zone_data.json for {domain_id}')
-
             return True
 
-        return False
+    def has_zone(self, domain_id: str) -> bool:
+        return exists(f'{self.config.ZONEFILE_LOCATION}/{domain_id}/zone_data.json')
 
-    def _handleRecords(self, tree: ZoneDataFormat, record_type: str, content: str, prio=0):
-        """ Handle all necessary transformations on the records """
-        if record_type in self.arrayRecords:
-            self._handleArrayRecords(tree, record_type, content, prio)
-        else:
-            if record_type == 'CNAME':
-                tree['ANY'] = {
-                    'type': 'CNAME',
-                    'data': { 'destination': content }
-                }
-            elif record_type == 'SRV':
-                values = content.split(' ')
-                tree[record_type] = {
-                    'type': 'static',
-                    'data': {
-                        'priority': int(values[0]),
-                        'weight': int(values[1]),
-                        'port': int(values[2]),
-                        'target': values[3]
-                    }
-                }
-            else:
-                tree[record_type] = content
-
-    def _handleArrayRecords(self, tree: ZoneDataFormat, record_type: str, content: str, prio=0):
-        """ Handle all necessary transformations on the records that are arrays (that accept multiple values) """
-        if not record_type in tree or not isinstance(tree[record_type], list):
-            tree[record_type] = []
-        record = None
+    def _recordValue(self, record_type: str, content: str, prio=0):
+        """ The dnsdng representation of a record that goes in an array, or None if it is invalid """
         match record_type:
             case 'CAA':
                 values = content.split(' ')
                 flags = int(values[0])
-                record = {
+                return {
                     'flags': flags,
                     'tag': values[1],
                     'value': values[2].replace('"', ''),
@@ -133,145 +158,123 @@ class HellomouseZoneBot(BaseZoneBot):
                 }
             case 'MX':
                 if prio != 0:
-                    record = {
+                    return {
                         'preference': prio,
                         'exchange': content
                     }
-                else:
-                    record = {
-                        'exchange': content
-                    }
-                
+                return {
+                    'exchange': content
+                }
             case 'SSHFP':
                 values = content.split(' ')
-                record ={
+                return {
                     'algorithm': int(values[0]),
                     'fingerprintType': int(values[1]),
                     'fingerprint': values[2]
                 }
-            case 'TXT':
-                if len(tree[record_type]) == 1:
-                    if content not in tree[record_type]:
-                        tree[record_type] = [tree[record_type], [content]]
-                elif len(tree[record_type]) > 1:
-                    if [content] not in tree[record_type]:
-                        tree[record_type].append([content])
-                else:
-                    if content not in tree[record_type]:
-                        tree[record_type].append(content)
             case 'URI':
                 values = content.split(' ')
                 if len(values) != 3:
-                    print(f'Got an invalid record! (Bad value) {record_type} {content}')
-                else:
-                    tree[record_type].append({
-                        'priority': int(values[0]),
-                        'weight': int(values[1]),
-                        'target': values[2]
-                    })
-            case 'AAAA' | 'A':
-                tree[record_type].append(content)
-
+                    deploy_log.warning('Got an invalid record! (Bad value) %s %s', record_type, content)
+                    return None
+                return {
+                    'priority': int(values[0]),
+                    'weight': int(values[1]),
+                    'target': values[2]
+                }
             case _:
-                tree[record_type].append(content)
-
-        if record not in tree[record_type] and record is not None:
-            tree[record_type].append(record)
+                return content
 
     def insert_dns_record(self, domain_id: str, name: str, record_type: str, content: str, prio=0, ttl=3600):
-        # We have to read the zone file here, because we must assure that the JSON data written to the file is valid, so we overwrite it every time
-        file = open(f'{self.config.ZONEFILE_LOCATION}/{domain_id}/zone_data.json', 'r', encoding='utf-8')
-        contents = file.read()
-        data = json.loads(contents)
-        zone: ZoneDataFormat = data['zone']
-        file.close()
-
-        with open(f'{self.config.ZONEFILE_LOCATION}/{domain_id}/zone_data.json', 'w+', encoding="utf-8") as f:
-
-            # The SOA record is not handled in the DNS records by us, it's handled by the system itself
-            if record_type == 'SOA':
-                data['soa'] = {
-                    'mname': self.config.SOA_NS,
-                    'rname': self.config.SOA_EMAIL,
-                    'serial': content.split(' ')[2],
-                    'refresh': 300,
-                    'retry': 60,
-                    'expire': 691200,
-                    'minimum': 3600
-                }
-            else:
-                # Remove the domain name from the record name
-                record_name = name.replace('.' + domain_id, '')
-                # Handle apex records
-                if record_name == '@' or record_name == domain_id:
-                    self._handleRecords(zone, record_type, content, prio)
-                # Handle child (subdomain) records
-                else:
-                    if not 'child' in zone:
-                        zone['child'] = {}
-
-                    # Handle multi-level subdomains
-                    if '.' in record_name:
-                        # Split the name into a list of subdomains, and reverse it to get the correct order (by depth)
-                        names = record_name.split('.')[::-1]
-                        current = zone
-
-                        # Iterate over all levels of the subdomains to create the data structure, and get to the last one
-                        for i in range(len(names)):
-                            if names[i] not in current['child']:
-                                current['child'][names[i]] = {}
-                            if i != len(names) - 1:
-                                if 'child' not in current['child'][names[i]]:
-                                    current['child'][names[i]]['child'] = {}
-                                current = current['child'][names[i]]
-
-                        self._handleRecords(current['child'][names[-1]], record_type, content, prio)
-                    # Handle single-level subdomains
-                    else:
-                        if not record_name in zone['child']:
-                            zone['child'][record_name] = {}
-
-                        self._handleRecords(zone['child'][record_name], record_type, content, prio)
-            json.dump(data, f, indent=2)
+        data = self.zones[domain_id]
+
+        # The SOA record is not handled in the DNS records by us, it's handled by the system itself
+        if record_type == 'SOA':
+            data['soa'] = {
+                'mname': self.config.SOA_NS,
+                'rname': self.config.SOA_EMAIL,
+                'serial': content.split(' ')[2],
+                'refresh': 300,
+                'retry': 60,
+                'expire': 691200,
+                'minimum': 3600
+            }
+            return
 
-    def _final_transformation(self, data) -> dict[str]:
-        if isinstance(data, dict):
-            return { key: self._final_transformation(val) if key in self.arrayRecords or isinstance(val, dict) else val for key, val in data.items() }
-        return {
-            'type': 'static',
-            'data': [{ 'data': i } for i in flatten(data)] if type(data) is list else [{ 'data': data }]
-        }
+        # Remove the domain name from the record name, what's left are the labels of the subdomain (if any)
+        record_name = name.replace('.' + domain_id, '')
+        if record_name == '@' or record_name == domain_id:
+            labels = []
+        else:
+            # Reversed, to go down the tree from the apex
+            labels = record_name.split('.')[::-1]
+        node = data['zone'].node(labels)
+
+        if record_type in self.arrayRecords:
+            value = self._recordValue(record_type, content, prio)
+            if value is not None:
+                if not isinstance(node.get(record_type), RRSet):
+                    node[record_type] = RRSet()
+                node[record_type].add(value)
+        elif record_type == 'CNAME':
+            node['ANY'] = {
+                'type': 'CNAME',
+                'data': { 'destination': content }
+            }
+        else:
+            node[record_type] = content
 
     def post_update(self, domain_id: str):
         # Create the JavaScipt module to be loaded by the DNS server
         if not exists(f'{self.config.ZONEFILE_LOCATION}/{domain_id}/index.js'):
             # Why yes, we are writing javascript in Python
-            with open(f'{self.config.ZONEFILE_LOCATION}/{domain_id}/index.js', 'w+', encoding="utf-8") as f:
+            with atomic_open(f'{self.config.ZONEFILE_LOCATION}/{domain_id}/index.js', 'w', encoding="utf-8") as f:
                 f.write('const { zone, soa } = require("./zone_data.json");\n')
                 f.write('const Zone = require("../../src/module").Zone;\n')
                 f.write('\n')
                 f.write(f'module.exports = new Zone("{domain_id}", zone, soa);\n')
 
-        # Apply some final transformations to the zone file
-        # We have to read the zone file here, because we must assure that the JSON data written to the file is valid, so we overwrite it every time
-        file = open(f'{self.config.ZONEFILE_LOCATION}/{domain_id}/zone_data.json', 'r', encoding='utf-8')
-        data = json.loads(file.read())
-        file.close()
-
-        with open(f'{self.config.ZONEFILE_LOCATION}/{domain_id}/zone_data.json', 'w+', encoding="utf-8") as f:
-            # Ensure the we overwrite the existing data
-            data['zone'] = self._final_transformation(data['zone'])
+        # Apply some final transformations to the zone, and write it out in one go
+        data = self.zones.pop(domain_id)
+        data['zone'] = data['zone'].to_zone_data()
+        with atomic_open(f'{self.config.ZONEFILE_LOCATION}/{domain_id}/zone_data.json', 'w', encoding="utf-8") as f:
             json.dump(data, f, indent=2)
             f.write('\n')
 
-        # Reload the DNS server
-        subprocess.call(['pm2', 'restart', 'dnsdng'])
-        
-        # Add the domain to the CoreDNS config, only if it is not already there
-        with open(f'{self.config.COREDNS_LOCATION}/Corefile', 'r+', encoding="utf-8") as f:
-            contents = f.read()
+        # Reload the DNS server once we're done with all the zones
+        self.pending_restarts.add('dnsdng')
 
-            if domain_id not in contents:
-                f.write('\n')
-                f.write(f'{domain_id} {self.corednsTemplate}')
-                subprocess.call(['pm2', 'restart', 'coredns'])
+    def _read_corefile(self):
+        try:
+            with open(f'{self.config.COREDNS_LOCATION}/Corefile', 'r', encoding="utf-8") as f:
+                self.corefile = f.read()
+        except FileNotFoundError:
+            self.corefile = ''
+
+    def _update_corefile(self):
+        """ Regenerate the CoreDNS config from the zones we serve, restarting CoreDNS only if it changed """
+        if not self.served_zones:
+            return  # Never wipe the config because of an empty payload
+
+        contents = ''.join(f'{zone} {self.corednsTemplate}\n' for zone in sorted(self.served_zones))
+
+        if self.corefile is None:
+            self._read_corefile()
+
+        if contents == self.corefile:
+            return
+
+        with atomic_open(f'{self.config.COREDNS_LOCATION}/Corefile', 'w', encoding="utf-8") as f:
+            f.write(contents)
+        self.corefile = contents
+        self.pending_restarts.add('coredns')
+
+    def _restart(self, service: str):
+        subprocess.call(['pm2', 'restart', service])
+
+    def post_db_update(self):
+        self._update_corefile()
+        for service in sorted(self.pending_restarts):
+            with metrics.timer('zonebot_reload_seconds', service=service):
+                self._restart(service)
+        self.pending_restarts.clear()
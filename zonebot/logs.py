@@ -0,0 +1,29 @@
+import logging
+import logging.handlers
+import queue
+import sys
+
+# IRC traffic and deploys are logged separately, so each of them can have its own level
+irc_log = logging.getLogger("zonebot.irc")
+deploy_log = logging.getLogger("zonebot.deploy")
+
+
+def setup_logging(config, stream=None, fmt="%(asctime)s %(levelname)s %(name)s: %(message)s"):
+    """ Sends every log record through a queue to a background thread that writes them to stream (stdout by default).
+
+    Logging then never blocks the event loop or the deploy threads, even when stdout is a pipe that fills up.
+    Returns the listener, stop() it to flush what is left in the queue.
+    """
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter(fmt))
+    listener = logging.handlers.QueueListener(records, handler)
+
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    root.setLevel(getattr(config, 'LOG_LEVEL', "WARNING"))
+    irc_log.setLevel(getattr(config, 'LOG_LEVEL_IRC', "INFO"))
+    deploy_log.setLevel(getattr(config, 'LOG_LEVEL_DEPLOY', "INFO"))
+
+    listener.start()
+    return listener
@@ -0,0 +1,120 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for key, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+class Metrics:
+    """ Thread-safe counters, gauges and timers, rendered in the Prometheus text format """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> (type, help)
+        self.descriptions: dict[str, tuple[str, str]] = {}
+        # (name, labels) -> value
+        self.values: dict[tuple[str, tuple], float] = {}
+
+    def _add(self, metric_type: str, name: str, value: float, labels: dict, replace=False):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.descriptions.setdefault(name, (metric_type, ''))
+            self.values[key] = value if replace else self.values.get(key, 0) + value
+
+    def describe(self, name: str, metric_type: str, help_text: str):
+        with self.lock:
+            self.descriptions[name] = (metric_type, help_text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self._add('counter', name, value, labels)
+
+    def set(self, name: str, value: float, **labels):
+        self._add('gauge', name, value, labels, replace=True)
+
+    def observe(self, name: str, seconds: float, **labels):
+        """ Adds a duration to a summary, exported as <name>_sum and <name>_count """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.descriptions.setdefault(name, ('summary', ''))
+            self.values[(f'{name}_sum', key)] = self.values.get((f'{name}_sum', key), 0) + seconds
+            self.values[(f'{name}_count', key)] = self.values.get((f'{name}_count', key), 0) + 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def get(self, name: str, **labels) -> float:
+        """ Sum of a metric over every label set matching the given labels """
+        wanted = set(labels.items())
+        with self.lock:
+            return sum(value for (key, key_labels), value in self.values.items()
+                       if key == name and wanted <= set(key_labels))
+
+    def render(self) -> str:
+        with self.lock:
+            values = list(self.values.items())
+            descriptions = dict(self.descriptions)
+
+        # Group the _sum and _count series of a summary under the summary's name
+        series = []
+        for (name, labels), value in values:
+            base_name = name
+            for suffix in ('_sum', '_count'):
+                if name.endswith(suffix) and descriptions.get(name[:-len(suffix)], ('',))[0] == 'summary':
+                    base_name = name[:-len(suffix)]
+            series.append((base_name, name, labels, value))
+
+        lines = []
+        described = set()
+        for base_name, name, labels, value in sorted(series):
+            if base_name not in described:
+                metric_type, help_text = descriptions.get(base_name, ('untyped', ''))
+                if help_text:
+                    lines.append(f'# HELP {base_name} {help_text}')
+                lines.append(f'# TYPE {base_name} {metric_type}')
+                described.add(base_name)
+            lines.append(f'{name}{_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, host: str, port: int):
+        """ Exposes the metrics on http://host:port/metrics """
+        async def handler(_request):
+            return web.Response(text=self.render(), content_type='text/plain', charset='utf-8')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+# Shared by the whole process
+metrics = Metrics()
+metrics.describe('zonebot_fetch_seconds', 'summary', "Time spent downloading the DNS API payload, and deploying it while it comes in")
+metrics.describe('zonebot_fetches_total', 'counter', "DNS API fetches by result")
+metrics.describe('zonebot_parse_seconds', 'summary', "Time spent parsing the DNS API payload")
+metrics.describe('zonebot_deploy_seconds', 'summary', "Time spent in the backend phase of a deploy")
+metrics.describe('zonebot_validate_seconds', 'summary', "Time spent validating a zone")
+metrics.describe('zonebot_zone_write_seconds', 'summary', "Time spent writing a zone to the backend")
+metrics.describe('zonebot_zones_total', 'counter', "Zones processed by result")
+metrics.describe('zonebot_records_accepted_total', 'counter', "Records that passed validation")
+metrics.describe('zonebot_records_rejected_total', 'counter', "Records that failed validation, by reason")
+metrics.describe('zonebot_zones_deleted_total', 'counter', "Zones deleted from the DNS server since they are gone from the wiki")
+metrics.describe('zonebot_reload_seconds', 'summary', "Time spent restarting DNS services")
+metrics.describe('zonebot_db_queries_total', 'counter', "Database statements issued")
+metrics.describe('zonebot_last_deploy_timestamp_seconds', 'gauge', "When the last deploy finished")
@@ -1,6 +1,11 @@
+from collections import Counter
+from typing import Optional
+
 import sqlalchemy
 
 from .base import BaseZoneBot
+from .logs import deploy_log
+from .metrics import metrics
 
 
 metadata = sqlalchemy.MetaData()
@@ -34,27 +39,158 @@ records = sqlalchemy.Table(
 
 
 class PowerDNSZoneBot(BaseZoneBot):
-    def __init__(self, bot, name: str, config):
-        super().__init__(bot, name, config)
+    dns_server = "powerdns"
+
+    def __init__(self, bot, name: str, config, headless=False):
+        super().__init__(bot, name, config, headless)
+        engine_options = {}
+        if sqlalchemy.engine.make_url(config.DATABASE_URL).get_backend_name() != 'sqlite':
+            # One connection for every zone being deployed in parallel
+            engine_options['pool_size'] = max(5, self.deploy_concurrency)
         self.engine = sqlalchemy.create_engine(
-            config.DATABASE_URL, pool_pre_ping=True
+            config.DATABASE_URL, pool_pre_ping=True, **engine_options
         )
+        sqlalchemy.event.listen(
+            self.engine, 'before_cursor_execute', lambda *_: metrics.inc('zonebot_db_queries_total')
+        )
+        # Rows collected for each zone being updated, written in one transaction by post_update
+        self.pending_records = {}
+        # "replace" rewrites every row of an updated zone, "diff" only touches the rows that changed
+        self.sync_mode = getattr(config, 'POWERDNS_SYNC_MODE', 'replace')
+        # Domain ids by name and SOA serials by domain id, loaded in bulk at the start of every deploy
+        self.domain_ids = {}
+        self.soa_serials = {}
+        # Names of every zone in the payload during a full deploy, None during a partial one
+        self.payload_zones = None
+        # Zones that are gone from the wiki get deleted, except these domain ids, and never more than this at once
+        self.protected_domains = set(getattr(config, 'DO_NOT_DELETE_DOMAINS', []))
+        self.max_deletions = getattr(config, 'POWERDNS_MAX_DELETIONS', 10)
+        # Why the last deletions were refused, so the warning isn't repeated on every deploy
+        self.refused_deletions = None
+        # SOA rows without a serial, for the same reason
+        self.malformed_soas = set()
 
     def insert_dns_record(self, domain_id, name, record_type, content, prio=0, ttl=3600):
-        new_r = sqlalchemy.insert(records).values(
-            domain_id=domain_id,
-            name=name,
-            type=record_type,
-            content=content,
-            ttl=ttl,
-            prio=prio,
-            disabled=0,
-            ordername=None,
-            auth=1
-        )
-        self.engine.execute(new_r)
+        self.pending_records[domain_id].append({
+            'domain_id': domain_id,
+            'name': name,
+            'type': record_type,
+            'content': content,
+            'ttl': ttl,
+            'prio': prio,
+            'disabled': 0,
+            'ordername': None,
+            'auth': 1
+        })
+
+    def pre_db_update(self):
+        # Load every domain and SOA serial up front instead of querying them zone by zone
+        with self.engine.connect() as conn:
+            self.domain_ids = {
+                name: int(domain_id)
+                for domain_id, name in conn.execute(sqlalchemy.select(domains.c.id, domains.c.name))
+            }
+            query = sqlalchemy.select(records.c.domain_id, records.c.content).where(records.c.type == 'SOA')
+            self.soa_serials = {}
+            malformed = set()
+            for domain_id, content in conn.execute(query):
+                fields = (content or "").split(" ")
+                if domain_id is None or len(fields) < 3:
+                    # Probably a hand-managed zone, these get left alone. Zones from the wiki get deployed again.
+                    malformed.add((domain_id, content))
+                    continue
+                self.soa_serials[int(domain_id)] = fields[2]
+
+        for domain_id, content in malformed - self.malformed_soas:
+            deploy_log.warning("Ignoring the SOA record of domain %s, it has no serial: %r", domain_id, content)
+        self.malformed_soas = malformed
+
+    def prepare_zones(self, zone_names: list, partial=False):
+        self.payload_zones = None if partial else set(zone_names)
+
+        # Create all the new domains at once
+        missing = [name for name in dict.fromkeys(zone_names) if name not in self.domain_ids]
+        if not missing:
+            return
+
+        with self.engine.begin() as conn:
+            conn.execute(domains.insert(), [{
+                'name': name,
+                'master': '',
+                'last_check': None,
+                'type': "MASTER",
+                'notified_serial': None,
+                'account': ''
+            } for name in missing])
+            query = sqlalchemy.select(domains.c.id, domains.c.name).where(domains.c.name.in_(missing))
+            for domain_id, name in conn.execute(query):
+                self.domain_ids[name] = int(domain_id)
+
+    def post_db_update(self):
+        if self.payload_zones is not None:
+            self._delete_vanished_zones()
+
+    def _vanished_zones(self, zone_names: set) -> dict[int, str]:
+        """ Zones in the database that aren't in the payload and aren't protected, by domain id """
+        return {
+            domain_id: name for name, domain_id in self.domain_ids.items()
+            if name not in zone_names and domain_id not in self.protected_domains
+        }
+
+    def _deletions_refusal(self, zone_names: set, vanished: dict) -> Optional[str]:
+        """ Why the vanished zones shouldn't be deleted, if they shouldn't """
+        if not zone_names:
+            return "the payload has no zones"
+        if len(vanished) > self.max_deletions:
+            return f"POWERDNS_MAX_DELETIONS is {self.max_deletions}"
+        return None
+
+    def _delete_vanished_zones(self):
+        vanished = self._vanished_zones(self.payload_zones)
+        if not vanished:
+            self.refused_deletions = None
+            return
+        refusal = self._deletions_refusal(self.payload_zones, vanished)
+        if refusal is not None:
+            # Most likely a broken payload rather than a mass exodus. The zones stay and the deploy goes on, until a
+            # human has a look.
+            message = f"Refusing to delete {len(vanished)} zones, {refusal}"
+            if message != self.refused_deletions:
+                deploy_log.warning("%s: %s", message, ", ".join(sorted(vanished.values())))
+                self.refused_deletions = message
+            return
+        self.refused_deletions = None
+
+        ids = list(vanished)
+        with self.engine.begin() as conn:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                conn.execute(records.delete().where(records.c.domain_id.in_(chunk)))
+                conn.execute(domains.delete().where(domains.c.id.in_(chunk)))
+
+        for domain_id, name in vanished.items():
+            deploy_log.info("Deleted zone %s (%s), it is gone from the wiki", name, domain_id)
+            del self.domain_ids[name]
+            self.soa_serials.pop(domain_id, None)
+        metrics.inc('zonebot_zones_deleted_total', len(vanished))
+
+    def dry_run(self, payload_domains: list) -> list[str]:
+        report = super().dry_run(payload_domains)
+        self.pre_db_update()
+        zone_names = {dom['name'] for dom in payload_domains}
+        vanished = self._vanished_zones(zone_names)
+        refusal = self._deletions_refusal(zone_names, vanished)
+        if vanished and refusal is not None:
+            report.append(f"Would refuse to delete {len(vanished)} zones, {refusal}:")
+        elif vanished:
+            report.append(f"Would delete {len(vanished)} zones:")
+        report.extend(f"  - {name} ({domain_id})" for domain_id, name in sorted(vanished.items()))
+        return report
 
     def get_zone(self, zone_name: str):
+        if zone_name in self.domain_ids:
+            return self.domain_ids[zone_name]
+
         query = domains.select().where(domains.c.name == zone_name)  # noqa
         result = self.engine.execute(query)
         record = result.fetchone()
@@ -75,19 +211,73 @@ class PowerDNSZoneBot(BaseZoneBot):
         else:
             domain_id = int(record[0])
 
+        self.domain_ids[zone_name] = domain_id
         return domain_id
 
     def needs_updating(self, domain_id, last_modified: int) -> bool:
         # Check if we need to update records by comparing the timestamp in the SOA record
-        query = records.select().where((records.c.domain_id == domain_id) & (records.c.type == 'SOA'))
-        result = self.engine.execute(query)
-        soa_ts = ""
-        if record := result.fetchone():
-            soa_ts = record[4].split(" ")[2]
+        return self.soa_serials.get(domain_id, "") != last_modified
 
-        return soa_ts != last_modified
+    def has_zone(self, domain_id) -> bool:
+        return domain_id in self.soa_serials
 
     def pre_update(self, domain_id, _):
-        # Delete all old records
-        query = records.delete().where(records.c.domain_id == domain_id)
-        self.engine.execute(query)
+        self.pending_records[domain_id] = []
+
+    def post_update(self, domain_id):
+        rows = self.pending_records.pop(domain_id)
+        with self.engine.begin() as conn:
+            if self.sync_mode == 'diff':
+                self._sync_records(conn, domain_id, rows)
+            else:
+                # Swap the old records for the new ones in a single transaction, so PowerDNS never serves a half-written zone
+                conn.execute(records.delete().where(records.c.domain_id == domain_id))
+                if rows:
+                    conn.execute(records.insert(), rows)
+
+    @staticmethod
+    def _record_key(name, record_type, content, prio, ttl):
+        return name, record_type, content, int(prio or 0), int(ttl or 0)
+
+    def _sync_records(self, conn, domain_id, rows):
+        """ Only delete and insert the rows that differ between the database and the new zone """
+        query = sqlalchemy.select(
+            records.c.id, records.c.name, records.c.type, records.c.content, records.c.prio, records.c.ttl
+        ).where(records.c.domain_id == domain_id)
+        existing = conn.execute(query).fetchall()
+
+        # The SOA changes on every update, bump it in place instead of churning the row
+        new_soa = next((row for row in rows if row['type'] == 'SOA'), None)
+        old_soa = next((row for row in existing if row.type == 'SOA'), None)
+        if new_soa is not None and old_soa is not None:
+            rows = [row for row in rows if row is not new_soa]
+            existing = [row for row in existing if row is not old_soa]
+            if (old_soa.content, old_soa.ttl) != (new_soa['content'], new_soa['ttl']):
+                conn.execute(
+                    records.update()
+                    .where(records.c.id == old_soa.id)
+                    .values(content=new_soa['content'], ttl=new_soa['ttl'])
+                )
+
+        wanted = Counter(
+            self._record_key(row['name'], row['type'], row['content'], row['prio'], row['ttl']) for row in rows
+        )
+        to_delete = []
+        for row in existing:
+            key = self._record_key(row.name, row.type, row.content, row.prio, row.ttl)
+            if wanted[key] > 0:
+                wanted[key] -= 1
+            else:
+                to_delete.append(row.id)
+
+        to_insert = []
+        for row in rows:
+            key = self._record_key(row['name'], row['type'], row['content'], row['prio'], row['ttl'])
+            if wanted[key] > 0:
+                wanted[key] -= 1
+                to_insert.append(row)
+
+        if to_delete:
+            conn.execute(records.delete().where(records.c.id.in_(to_delete)))
+        if to_insert:
+            conn.execute(records.insert(), to_insert)
@@ -0,0 +1,57 @@
+import asyncio
+import time
+from collections import deque
+from typing import Optional
+
+from .logs import deploy_log
+
+
+class DeployScheduler:
+    """ Coalesces deploy triggers, so at most one deploy runs at a time with at most one more queued behind it.
+
+    Triggers wait `debounce` seconds before the deploy starts, so a burst of wiki edits ends up in a single deploy.
+    Triggers that come in while a deploy is running are folded into one re-run after it.
+    Triggers for specific zones only deploy those zones, unless a full deploy was triggered as well.
+    """
+
+    def __init__(self, deploy, debounce: float = 5):
+        self.deploy = deploy
+        self.debounce = debounce
+        # (reason, time) of the triggers waiting for the next deploy
+        self.pending: list[tuple[str, float]] = []
+        self.force = False
+        # Zones to deploy, or None for all of them
+        self.zones: Optional[set[str]] = None
+        self.task = None
+        # (reason, seconds from the trigger until its deploy finished) of the latest triggers
+        self.latencies: deque[tuple[str, float]] = deque(maxlen=100)
+
+    def trigger(self, reason: str, force=False, zone: Optional[str] = None):
+        if not self.pending:
+            self.zones = set()
+        if zone is None:
+            self.zones = None
+        elif self.zones is not None:
+            self.zones.add(zone)
+        self.pending.append((reason, time.monotonic()))
+        self.force = self.force or force
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while self.pending:
+            await asyncio.sleep(self.debounce)
+            triggers, self.pending = self.pending, []
+            force, self.force = self.force, False
+            zones, self.zones = self.zones, None
+            try:
+                await self.deploy(force=force, zones=zones)
+            except Exception as e:
+                deploy_log.error("Deploy failed: %r", e)
+
+            finished = time.monotonic()
+            for reason, triggered_at in triggers:
+                self.latencies.append((reason, finished - triggered_at))
+            reasons = ", ".join(sorted({reason for reason, _ in triggers}))
+            deploy_log.info("Deploy for %d trigger(s) (%s) done, max latency %.1fs",
+                            len(triggers), reasons, finished - min(t for _, t in triggers))
@@ -0,0 +1,77 @@
+import glob
+import gzip
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+from .logs import deploy_log
+
+
+class SnapshotWriter:
+    """ Compresses a payload to disk while it is coming in. It only becomes a snapshot once commit() is called.
+
+    A failing write doesn't stop the deploy, the error is raised by commit() instead.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.tmp_path = os.path.join(directory, f".snapshot.tmp-{os.getpid()}-{threading.get_ident()}")
+        self.file = open(self.tmp_path, 'wb')
+        self.gz = gzip.GzipFile(filename='', fileobj=self.file, mode='wb')
+        self.error: Optional[OSError] = None
+        # The payload is embedded as is, it's JSON already
+        self.gz.write(b'{"payload": ')
+
+    def write(self, chunk: bytes):
+        if self.error is not None:
+            return
+        try:
+            self.gz.write(chunk)
+        except OSError as e:
+            self.error = e
+
+    def commit(self, source_hash: str, digests: dict, keep: int = 5) -> str:
+        """ Stores the payload along with the digests of its zones, and removes all but the `keep` latest snapshots """
+        if self.error is not None:
+            raise self.error
+        metadata = {'source_hash': source_hash, 'saved_at': time.time(), 'digests': digests}
+        self.gz.write(b', ' + json.dumps(metadata)[1:].encode())
+        self.gz.close()
+        self.file.close()
+        saved_at = time.strftime('%Y%m%dT%H%M%S', time.gmtime(metadata['saved_at']))
+        path = os.path.join(self.directory, f"snapshot-{saved_at}-{source_hash}.json.gz")
+        os.replace(self.tmp_path, path)
+
+        for old in sorted(glob.glob(os.path.join(self.directory, "snapshot-*.json.gz")))[:-max(keep, 1)]:
+            os.remove(old)
+        return path
+
+    def discard(self):
+        if self.file.closed:
+            return
+        try:
+            self.gz.close()
+        except OSError:
+            pass  # It's going away anyway
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+def load_latest_snapshot(directory: str) -> Optional[dict]:
+    """ The latest snapshot that can still be read, or None if there is none """
+    for path in sorted(glob.glob(os.path.join(directory, "snapshot-*.json.gz")), reverse=True):
+        try:
+            with gzip.open(path, 'rb') as f:
+                snapshot = json.load(f)
+        except (OSError, EOFError, ValueError) as e:
+            deploy_log.warning("Skipping unreadable snapshot %s: %r", path, e)
+            continue
+        if 'domains' not in snapshot.get('payload', {}):
+            deploy_log.warning("Skipping snapshot %s without any domains", path)
+            continue
+        snapshot['path'] = path
+        return snapshot
+    return None
@@ -0,0 +1,246 @@
+import asyncio
+import codecs
+import json
+import queue
+import re
+from typing import Optional
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+# Skips everything up to the next bracket outside of a string, which is all that matters when looking for the end of an
+# object or array. Group 1 is that bracket. Without one, the text either ends in the middle of a string (group 2),
+# maybe in the middle of an escape sequence too (group 3), or not.
+_string = r'[^"\\]*(?:\\.[^"\\]*)*'
+_token = re.compile(rf'(?:[^"{{}}\[\]]|"{_string}")*(?:([{{}}\[\]])|(")(?:{_string})(\\)?\Z|\Z)', re.DOTALL)
+# The rest of a string the last chunk ended in, group 1 is its closing quote
+_string_rest = re.compile(rf'{_string}(?:(")|(\\)?\Z)', re.DOTALL)
+
+
+class PayloadParser:
+    """ Incremental parser for the API payload, so zones can be deployed while the rest is still coming in.
+
+    The payload is a JSON object with a "domains" array. feed() takes the payload chunk by chunk, and returns
+    ('domains', domain) for every element of the array, and (key, value) for the other fields, as soon as they are
+    complete. Raises ValueError if the payload is broken.
+
+    Objects, arrays and strings are only decoded once their end has come in. Until then only the new chunks are
+    scanned for it, so a zone spread over many chunks doesn't get parsed over and over again.
+    """
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.state = 'start'
+        self.key = None
+        # The text of the unfinished object, array or string so far, and where the scan for its end is at
+        self.parts: list[str] = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def _value(self, pos: int, final: bool):
+        """ The scalar value starting at pos and where it ends, or None if it isn't complete yet """
+        try:
+            value, end = self.decoder.raw_decode(self.buffer, pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return None
+        if not final and (end == len(self.buffer) or self.buffer[end] not in ' \t\n\r,:]}'):
+            return None  # A number could go on in the next chunk
+        return value, end
+
+    def _scan(self, text: str, pos: int) -> Optional[int]:
+        """ Looks for the end of the object, array or string being scanned, returns where it ends in text or None """
+        depth = self.depth
+        if self.in_string:
+            if self.escaped:
+                if pos == len(text):
+                    return None
+                # The last chunk ended right after a backslash
+                pos += 1
+            match = _string_rest.match(text, pos)
+            if match.group(1) is None:
+                self.escaped = match.group(2) is not None
+                return None
+            self.in_string = self.escaped = False
+            pos = match.end()
+            if depth == 0:
+                return pos
+
+        while pos < len(text):
+            match = _token.match(text, pos)
+            pos = match.end()
+            if match.group(1) is None:
+                if match.group(2) is not None:
+                    self.in_string = True
+                    self.escaped = match.group(3) is not None
+                break
+            if match.group(1) in '{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return pos
+        self.depth = depth
+        return None
+
+    def _complete(self, text: str, events: list):
+        """ Decodes a complete object, array or string """
+        self.depth, self.in_string, self.escaped = 0, False, False
+        self._emit(json.loads(text), events)
+
+    def _emit(self, value, events: list):
+        if self.state == 'element':
+            events.append(('domains', value))
+            self.state = 'element_next'
+        else:
+            events.append((self.key, value))
+            self.state = 'next'
+
+    def feed(self, chunk: bytes, final=False) -> list[tuple[str, object]]:
+        text = self.text_decoder.decode(chunk, final)
+        events = []
+        if self.parts:
+            end = self._scan(text, 0)
+            if end is None:
+                self.parts.append(text)
+                if final:
+                    raise ValueError("The payload ended early")
+                return events
+            self.parts.append(text[:end])
+            value_text = ''.join(self.parts)
+            self.parts = []
+            self._complete(value_text, events)
+            text = text[end:]
+
+        self.buffer += text
+        pos = 0
+        while True:
+            pos = _whitespace.match(self.buffer, pos).end()
+            if pos == len(self.buffer):
+                break
+            char = self.buffer[pos]
+
+            if self.state == 'start':
+                if char != '{':
+                    raise ValueError(f"Expected an object, got {char!r}")
+                pos += 1
+                self.state = 'key'
+            elif self.state == 'key':
+                if char == '}':
+                    pos += 1
+                    self.state = 'end'
+                    continue
+                result = self._value(pos, final)
+                if result is None:
+                    break
+                key, end = result
+                end = _whitespace.match(self.buffer, end).end()
+                if end == len(self.buffer) and not final:
+                    break  # Wait for the colon
+                if not isinstance(key, str) or self.buffer[end:end + 1] != ':':
+                    raise ValueError(f"Bad key at position {pos}")
+                pos = end + 1
+                self.key = key
+                self.state = 'array' if key == 'domains' else 'value'
+            elif self.state in ('value', 'element'):
+                if self.state == 'element' and char == ']':
+                    pos += 1
+                    self.state = 'next'
+                    continue
+                if char in '{["':
+                    self.in_string = char == '"'
+                    end = self._scan(self.buffer, pos + 1 if self.in_string else pos)
+                    if end is None:
+                        # Keep the start of the value aside, the next chunks only get scanned for its end
+                        self.parts = [self.buffer[pos:]]
+                        pos = len(self.buffer)
+                        break
+                    self._complete(self.buffer[pos:end], events)
+                    pos = end
+                    continue
+                result = self._value(pos, final)
+                if result is None:
+                    break
+                value, pos = result
+                self._emit(value, events)
+            elif self.state == 'array':
+                if char != '[':
+                    raise ValueError("domains is not an array")
+                pos += 1
+                self.state = 'element'
+            elif self.state in ('element_next', 'next'):
+                if char == ',':
+                    self.state = 'element' if self.state == 'element_next' else 'key'
+                elif char == ('}' if self.state == 'next' else ']'):
+                    self.state = 'end' if self.state == 'next' else 'next'
+                else:
+                    raise ValueError(f"Unexpected {char!r} at position {pos}")
+                pos += 1
+            else:
+                raise ValueError("Data after the end of the payload")
+
+        # Only keep what we couldn't parse yet
+        self.buffer = self.buffer[pos:]
+        if final and (self.state != 'end' or self.parts):
+            raise ValueError("The payload ended early")
+        return events
+
+
+class DeployAborted(Exception):
+    """ Raised in the deploy threads when the zones stopped coming in halfway, e.g. because the download failed """
+
+
+class ZoneFeed:
+    """ Hands zones from the event loop to the deploy thread of a backend.
+
+    The buffer is bounded, so a slow backend slows down the download instead of piling up zones in memory.
+    """
+    _end = object()
+
+    def __init__(self, maxsize=64):
+        self.queue = queue.Queue(maxsize)
+        self.aborted = False
+
+    async def put(self, item, consumer: asyncio.Future):
+        # A backend that failed doesn't take any zones anymore
+        while not consumer.done():
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.01)
+
+    async def close(self, consumer: asyncio.Future):
+        await self.put(self._end, consumer)
+
+    def abort(self):
+        self.aborted = True
+        try:
+            self.queue.put_nowait(self._end)
+        except queue.Full:
+            pass  # The deploy thread sees the flag when it takes the next zone
+
+    def batches(self, size: int):
+        """ Blocks until there is a zone, then yields it along with the others that are already waiting """
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self.aborted:
+                raise DeployAborted("The zones stopped coming in")
+            if batch[-1] is self._end:
+                if len(batch) > 1:
+                    yield batch[:-1]
+                return
+            yield batch
+
+
+async def iterate(items):
+    """ An async iterator over a list, for the code that takes streams """
+    for item in items:
+        yield item
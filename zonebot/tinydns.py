@@ -1,54 +1,134 @@
 import ipaddress
-import os
 from datetime import datetime
+from os.path import exists
+from typing import NamedTuple
 
 from .base import BaseZoneBot
+from .cdb import TinyDNSData
+from .utils import atomic_open
+
+
+class OctalEscapes(dict):
+    """ str.translate table turning every character into a \\ooo escape, precomputed for the first 256 code points """
+
+    def __missing__(self, codepoint):
+        escape = self[codepoint] = "\\" + oct(codepoint)[2:].zfill(3)
+        return escape
+
+
+OCTAL_ESCAPES = OctalEscapes({codepoint: "\\" + oct(codepoint)[2:].zfill(3) for codepoint in range(256)})
+# The same escapes indexed by byte value, for binary record data
+OCTAL_BYTE_ESCAPES = [OCTAL_ESCAPES[i] for i in range(256)]
+
+
+class ZoneFragment(NamedTuple):
+    last_modified: str
+    lines: list[str]
+    # Compiled data.cdb entries, only filled in when compiling to cdb
+    entries: list[tuple[bytes, bytes]]
 
 
 class TinyDNSZoneBot(BaseZoneBot):
+    dns_server = "tinydns"
+
+    def __init__(self, bot, name: str, config, headless=False):
+        super().__init__(bot, name, config, headless)
+        # When set, the records are also compiled straight into this data.cdb, without running tinydns-data
+        self.cdb_location = getattr(config, 'TINYDNS_CDB_LOCATION', None)
+        self.cdb_data = None
+        # Rendered output of every zone, keyed by name, so unchanged zones don't have to be rendered again
+        self.fragments: dict[str, ZoneFragment] = {}
+        # Zones being rendered right now, moved into fragments once they're complete
+        self.pending_fragments: dict[str, ZoneFragment] = {}
+        # Order of the zones in the payload, which is the order they are written in
+        self.zone_order: dict[str, None] = {}
+
     def pre_update(self, domain_id, domain_data):
-        with open("output-zones", "a") as f:
-            f.write(f"\n# Zone: {domain_id}\n")
-            f.write(f"# Owner: {domain_data['owner']}\n")  # I bet you want to sanitize this
+        self.pending_fragments[domain_id] = ZoneFragment(domain_data['last_modified'], [
+            f"\n# Zone: {domain_id}\n",
+            f"# Owner: {domain_data['owner']}\n",  # I bet you want to sanitize this
+        ], [])
 
     def insert_dns_record(self, domain_id, name, record_type, content, prio=0, ttl=3600):
-        f = open("output-zones", "a")
         if record_type == "SOA":
             content = content.split(" ")
-            f.write(f"Z{name}:{content[0].strip('.')}:{content[1].strip('.')}:{content[2]}\n")
+            line = f"Z{name}:{content[0].strip('.')}:{content[1].strip('.')}:{content[2]}\n"
         elif record_type == "NS":
-            f.write(f".{name}::{content}:{ttl}\n")
+            line = f".{name}::{content}:{ttl}\n"
         elif record_type == "A":
-            f.write(f"+{name}:{content}:{ttl}\n")
+            line = f"+{name}:{content}:{ttl}\n"
         elif record_type == "AAAA":
-            content = "".join(map(lambda x: '\\' + oct(x)[2:].zfill(3), ipaddress.ip_address(content).packed))
-            f.write(f":{name}:28:{content}:{ttl}\n")
+            content = "".join([OCTAL_BYTE_ESCAPES[x] for x in ipaddress.ip_address(content).packed])
+            line = f":{name}:28:{content}:{ttl}\n"
         elif record_type == "TXT":
-            f.write(f"'{name}:{self.sane_txt(content)}:{ttl}\n")
+            line = f"'{name}:{self.sane_txt(content)}:{ttl}\n"
         elif record_type == "CNAME":
-            f.write(f"C{name}:{content}:{ttl}\n")
+            line = f"C{name}:{content}:{ttl}\n"
         elif record_type == "MX":
-            f.write(f"@{name}::{content}:{prio}\n")
-        f.close()
+            line = f"@{name}::{content}:{prio}\n"
+        else:
+            return
+
+        fragment = self.pending_fragments[domain_id]
+        fragment.lines.append(line)
+        if self.cdb_data is not None:
+            fragment.entries.extend(self.cdb_data.compile_line(line))
+
+    def post_update(self, domain_id):
+        self.fragments[domain_id] = self.pending_fragments.pop(domain_id)
 
     def sane_txt(self, x):
         if '#' in x:
             x = x.split('#')[0]
-        items = []
-        for c in x:
-            items.append("\\" + oct(ord(c))[2:].zfill(3))
-        return "".join(items)
+        return x.translate(OCTAL_ESCAPES)
 
     def get_zone(self, zone_name: str):
         return zone_name
 
+    def snapshot_zones(self, zones: list) -> list:
+        # The data file is rebuilt from the zones in memory, and none of them are there after a restart. If the last
+        # data file is still around it is at least as recent as the snapshot, keep serving it until the next full deploy
+        # instead.
+        if exists("output-zones"):
+            return []
+        return zones
+
     def pre_db_update(self):
-        try:
-            os.remove("output-zones")
-        except FileNotFoundError:
-            pass
-        with open("output-zones", "w") as f:
+        if self.cdb_location:
+            self.cdb_data = TinyDNSData()
+
+    def prepare_zones(self, zone_names: list, partial=False):
+        if partial:
+            # Keep the zones we're not deploying now, new zones go at the end
+            self.zone_order.update(dict.fromkeys(zone_names))
+            return
+        self.zone_order = dict.fromkeys(zone_names)
+        # Forget about the zones that are gone
+        for zone in self.fragments.keys() - self.zone_order.keys():
+            del self.fragments[zone]
+
+    def post_db_update(self):
+        # Build the data file out of the fragments, whether they were rendered now or in an earlier deploy.
+        # It's renamed into place at the end, so tinydns-data never sees a half-written file
+        with atomic_open("output-zones", "w", buffering=1 << 20) as f:
             f.write(f"# Last-modified: {datetime.utcnow().isoformat()}\n")
+            for zone in self.zone_order:
+                if zone in self.fragments:
+                    f.writelines(self.fragments[zone].lines)
+
+        if self.cdb_data is None:
+            return
+        for zone in self.zone_order:
+            if zone in self.fragments:
+                self.cdb_data.entries.extend(self.fragments[zone].entries)
+        # Swap the new database in atomically, like tinydns-data does with data.tmp
+        with atomic_open(self.cdb_location, 'wb') as f:
+            self.cdb_data.write(f)
+        self.cdb_data = None
 
     def needs_updating(self, domain_id, last_modified: int) -> bool:
-        return True
+        fragment = self.fragments.get(domain_id)
+        return fragment is None or fragment.last_modified != last_modified
+
+    def has_zone(self, domain_id) -> bool:
+        return domain_id in self.fragments
@@ -0,0 +1,19 @@
+import os
+import threading
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_open(path: str, mode: str = 'w', **kwargs):
+    """ Write to a temporary file next to path, and rename it over path once the block finished without errors """
+    tmp_path = f'{path}.tmp-{os.getpid()}-{threading.get_ident()}'
+    try:
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
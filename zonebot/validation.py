@@ -0,0 +1,185 @@
+import hashlib
+import re
+from ipaddress import IPv4Address, AddressValueError, IPv6Address
+from typing import NamedTuple
+
+_hostname = re.compile(r"^[a-zA-Z0-9.-_]+$")
+_caa = re.compile(r"^(\d{1,3}) ([a-z0-9]+) \"([a-zA-Z0-9\-._@:;/= ]+)\"$")
+_label = re.compile(r"^[a-zA-Z0-9._-]+$")
+
+
+class Record(NamedTuple):
+    """ A validated record, in the argument order of BaseZoneBot.insert_dns_record """
+    name: str
+    type: str
+    content: str
+    prio: int = 0
+    ttl: int = 3600
+
+
+class ValidatedZone(NamedTuple):
+    """ A domain from the API along with its validated records, shared by every backend we deploy to """
+    domain: dict
+    records: list[Record]
+    rejected: list[tuple[str, object]]
+    digest: str
+
+
+class InvalidRecord(ValueError):
+    """ Raised by the validators, the message is the reason the record got rejected """
+
+
+def _validate_a(value):
+    try:
+        IPv4Address(value)
+    except AddressValueError:
+        raise InvalidRecord("Bad IPv4")
+    return value, 0
+
+
+def _validate_aaaa(value):
+    try:
+        IPv6Address(value)
+    except AddressValueError:
+        raise InvalidRecord("Bad IPv6")
+    return value, 0
+
+
+def _check_name(name):
+    """ Raises InvalidRecord unless name fits in a DNS name: labels of up to 63 bytes, 253 bytes in all """
+    if any(len(label) > 63 for label in name.encode().split(b'.')):
+        raise InvalidRecord("Label too long")
+    if len(name.encode().rstrip(b'.')) > 253:
+        raise InvalidRecord("Name too long")
+
+
+def _validate_hostname(value):
+    if not _hostname.match(value):
+        raise InvalidRecord("Bad value")
+    _check_name(value)
+    return value, 0
+
+
+def _validate_caa(value):
+    if not _caa.match(value):
+        raise InvalidRecord("Bad value")
+    return value, 0
+
+
+def _validate_mx(value):
+    splt = value.split(" ")
+    if len(splt) == 2:  # We got a prio!
+        try:
+            prio = int(splt[0])
+        except ValueError:
+            raise InvalidRecord("Bad value")
+        if not 0 <= prio <= 65535:
+            raise InvalidRecord("Bad value")
+        _check_name(splt[1])
+        return splt[1], prio
+    elif len(splt) > 2:
+        raise InvalidRecord("Bad value")
+    _check_name(value)
+    return value, 0
+
+
+def _validate_txt(value):
+    return value, 0
+
+
+# Record types users may put in their zones. The validators return the content and priority of a record value,
+# or raise InvalidRecord
+VALIDATORS = {
+    'A': _validate_a,
+    'AAAA': _validate_aaaa,
+    'CNAME': _validate_hostname,
+    'NS': _validate_hostname,
+    'CAA': _validate_caa,
+    'MX': _validate_mx,
+    'TXT': _validate_txt,
+}
+
+
+def validate_zone(dom: dict, config) -> tuple[list[Record], list[tuple[str, object]]]:
+    """ Turns a domain from the API into the records to deploy for it.
+
+    Returns the validated records, including the SOA, TXT and NS records we add to every zone, and a list of
+    (reason, record) tuples for the records that got rejected.
+    """
+    zone_name = dom['name']
+    records = [
+        Record(zone_name, 'SOA', f"{config.SOA_NS} {config.SOA_EMAIL} {dom['last_modified']} 300 60 691200 3600", 0, 7200),
+        Record(zone_name, 'TXT', "Zone managed by the pissnet wiki DNS system. "
+                                 "Contact #pisswiki on ircs://irc.letspiss.net/#pisswiki for abuse with full logs.", 0, 300),
+    ]
+    records.extend(Record(zone_name, 'NS', ns) for ns in config.NAMESERVERS)
+
+    rejected = []
+    candidates = []
+    cname_names = set()
+    for rec in dom['records']:
+        # Ignore invalid stuff
+        validator = VALIDATORS.get(rec['type'])
+        if validator is None:
+            continue
+
+        value = rec['value']
+        if len(value) > 255:
+            rejected.append(("Value too long", rec))
+            continue
+
+        try:
+            content, prio = validator(value)
+        except InvalidRecord as e:
+            rejected.append((str(e), rec))
+            continue
+
+        name = rec['name']
+        if name == '@':
+            if rec['type'] in ('CNAME', 'NS'):
+                rejected.append(("CNAME or NS on root not allowed", rec))
+                continue
+            rec_name = zone_name
+        else:
+            # Name must be valid dns
+            if not _label.match(name):
+                rejected.append(("Bad label", rec))
+                continue
+            rec_name = f"{name}.{zone_name}"
+
+        try:
+            _check_name(rec_name)
+        except InvalidRecord as e:
+            rejected.append((str(e), rec))
+            continue
+
+        if rec['type'] == 'CNAME':
+            cname_names.add(rec_name)
+
+        candidates.append(Record(rec_name, rec['type'], content, prio, 60))  # TODO: Configurable TTL (wiki task)
+
+    # A name with a CNAME can't have any other record, including a second CNAME
+    cnames_inserted = set()
+    for record in candidates:
+        if record.name in cname_names:
+            if record.type != 'CNAME':
+                rejected.append(("Non-CNAME record for an entry that already has a CNAME", record))
+                continue
+            if record.name in cnames_inserted:
+                rejected.append(("CNAME record for an entry that already has a CNAME", record))
+                continue
+            cnames_inserted.add(record.name)
+        records.append(record)
+
+    return records, rejected
+
+
+def zone_digest(records: list[Record]) -> str:
+    """ Fingerprint of the effective contents of a zone.
+
+    The SOA is left out, since its serial is the last_modified timestamp, which changes even when nothing else did.
+    """
+    digest = hashlib.sha1()
+    for record in sorted(record for record in records if record.type != 'SOA'):
+        digest.update(repr(tuple(record)).encode())
+    return digest.hexdigest()